@@ -1,28 +1,43 @@
-import gevent.monkey
-gevent.monkey.patch_all()
+import os
+# The ASGI entry point (asr.asgi) serves on asyncio instead of gevent
+ASR_SERVER = os.environ.get('ASR_SERVER', 'gevent').lower()
+if ASR_SERVER != 'asgi':
+    import gevent.monkey
+    gevent.monkey.patch_all()
 from email.mime.multipart import MIMEMultipart
 from email.message import Message
-from .model_map import get_model_for_lang
+from .language_routing import LanguageRouter, parse_routes, normalize_locale, language_from_header_parts
+from .vosk_models import VoskModelRegistry
+from .vosk_pool import VoskProcessPool
+from .vosk_stream import VoskStream, accept, final_text
+from .multipart import parse_boundary, iter_parts
+from .audio import skip_header_parts, trim_frames, trim_silence, decode_frames, DecoderPool, PcmBuffer, estimate_pcm_size
+from .http_client import HttpClient
+from .dsp import AudioProcessor
+from .encoders import get_encoder
+from .hedging import Hedger, LatencyTracker
+from .circuit_breaker import CircuitBreaker
+from .admission import AdmissionLimiter, Overloaded
+from .deadline import DeadlineExceeded, request_deadline, remaining, enforce
+from .recordings import RecordingStore
+from . import metrics
+from .transcript_cache import TranscriptCache, RedisCacheBackend, HAS_REDIS, cache_key
 import json
-import os
 import struct
+import inspect
 import requests
 import io
-import wave
 import time
-import audioop
+import sqlite3
+import queue
 import logging
-import asyncio
-from datetime import datetime
 from speex import SpeexDecoder
 from flask import Flask, request, Response, abort
 
 # Wyoming imports
 try:
     import wyoming
-    from wyoming.asr import Transcribe, Transcript
-    from wyoming.audio import AudioChunk, AudioStart, AudioStop
-    from wyoming.client import AsyncTcpClient
+    from .wyoming_client import WyomingStream, WyomingConnectionPool, WyomingBackend, WyomingBalancer, parse_hosts
     HAS_WYOMING = True
 except ImportError:
     HAS_WYOMING = False
@@ -43,23 +58,125 @@ if DEBUG:
 else:
     logger.setLevel(logging.INFO)
 
-decoder = SpeexDecoder(1)
 app = Flask(__name__)
 
 # Get API key from environment, or None if not set
 API_KEY = os.environ.get('ASR_API_KEY')
 
+# Cloud provider endpoints (overridable, e.g. to point at a local stand-in server)
+GROQ_API_URL = os.environ.get('GROQ_API_URL', 'https://api.groq.com/openai/v1/audio/transcriptions')
+ELEVENLABS_API_URL = os.environ.get('ELEVENLABS_API_URL', 'https://api.elevenlabs.io/v1/speech-to-text')
+
+# Audio format uploaded to each cloud provider: 'wav', 'flac' (lossless) or 'opus'
+GROQ_AUDIO_FORMAT = os.environ.get('GROQ_AUDIO_FORMAT', 'flac')
+ELEVENLABS_AUDIO_FORMAT = os.environ.get('ELEVENLABS_AUDIO_FORMAT', 'flac')
+
+# Models asked of the cloud providers, unless a language route names another
+GROQ_MODEL = os.environ.get('GROQ_MODEL', 'whisper-large-v3')
+ELEVENLABS_MODEL = os.environ.get('ELEVENLABS_MODEL', 'scribe_v1')
+
+# Per-language providers, e.g. 'de=wyoming-whisper@whisper-de:10300,en=groq/whisper-large-v3-turbo'
+LANGUAGE_ROUTES = os.environ.get('LANGUAGE_ROUTES', '')
+# Tell the providers the dictation language so they can skip detecting it
+LANGUAGE_HINTS = os.environ.get('LANGUAGE_HINTS', 'true').lower() in ('true', '1', 't', 'yes')
+
+# HTTP connection pool and timeouts for the cloud providers
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+
 # Get Wyoming connection details from environment
 WYOMING_HOST = os.environ.get('WYOMING_HOST', 'localhost')
 WYOMING_PORT = int(os.environ.get('WYOMING_PORT', '10300'))
+# Optional comma-separated list of host[:port] backends, overrides WYOMING_HOST/WYOMING_PORT
+WYOMING_HOSTS = os.environ.get('WYOMING_HOSTS', '')
+WYOMING_LB_POLICY = os.environ.get('WYOMING_LB_POLICY', 'least-outstanding')
+WYOMING_MAX_CONCURRENCY = int(os.environ.get('WYOMING_MAX_CONCURRENCY', '0'))
+WYOMING_EJECT_FAILURES = int(os.environ.get('WYOMING_EJECT_FAILURES', '3'))
+WYOMING_EJECT_SECONDS = float(os.environ.get('WYOMING_EJECT_SECONDS', '30'))
+# Audio is forwarded to Wyoming in chunks of this many milliseconds while the upload arrives
+WYOMING_CHUNK_MS = int(os.environ.get('WYOMING_CHUNK_MS', '100'))
+# Number of connected, ready-to-use Wyoming connections each worker keeps
+WYOMING_POOL_SIZE = int(os.environ.get('WYOMING_POOL_SIZE', '2'))
+WYOMING_CONNECT_TIMEOUT = float(os.environ.get('WYOMING_CONNECT_TIMEOUT', '5'))
+WYOMING_HEALTH_INTERVAL = float(os.environ.get('WYOMING_HEALTH_INTERVAL', '15'))
 
 # Audio recording configuration
 SAVE_RECORDINGS = os.environ.get('SAVE_RECORDINGS', 'false').lower() in ('true', '1', 't', 'yes')
 AUDIO_RECORDINGS_DIR = os.environ.get('AUDIO_RECORDINGS_DIR')
 MAX_AUDIO_RECORDINGS = int(os.environ.get('MAX_AUDIO_RECORDINGS', '10'))
-
-# Audio settings for Wyoming
-SAMPLE_RATE = 16000
+MAX_AUDIO_RECORDINGS_MB = float(os.environ.get('MAX_AUDIO_RECORDINGS_MB', '0'))
+# Recordings are written in the background; at most this many wait, further ones are dropped
+RECORDINGS_QUEUE_SIZE = int(os.environ.get('RECORDINGS_QUEUE_SIZE', '64'))
+
+# Vosk configuration
+VOSK_MODEL_PATH = os.environ.get('VOSK_MODEL_PATH', '/code/model')
+VOSK_MODELS_DIR = os.environ.get('VOSK_MODELS_DIR')
+VOSK_MODEL_MEMORY_BUDGET_MB = int(os.environ.get('VOSK_MODEL_MEMORY_BUDGET_MB', '0'))
+VOSK_RECOGNIZER_POOL_SIZE = int(os.environ.get('VOSK_RECOGNIZER_POOL_SIZE', '4'))
+VOSK_PROCESSES = int(os.environ.get('VOSK_PROCESSES', '0'))
+VOSK_QUEUE_SIZE = int(os.environ.get('VOSK_QUEUE_SIZE', '16'))
+VOSK_JOB_TIMEOUT = float(os.environ.get('VOSK_JOB_TIMEOUT', '30'))
+# Recognise with Vosk while the upload arrives, feeding it blocks of this many milliseconds
+VOSK_STREAMING = os.environ.get('VOSK_STREAMING', 'true').lower() in ('true', '1', 't', 'yes')
+VOSK_STREAM_BLOCK_MS = int(os.environ.get('VOSK_STREAM_BLOCK_MS', '200'))
+
+# How silence is trimmed from the audio: 'vad' (by level), 'fixed' (a fixed number of frames) or 'none'
+AUDIO_TRIM = os.environ.get('AUDIO_TRIM', 'vad').lower()
+VAD_THRESHOLD_DB = float(os.environ.get('VAD_THRESHOLD_DB', '-40'))
+VAD_PADDING_MS = int(os.environ.get('VAD_PADDING_MS', '200'))
+VAD_MAX_PAUSE_MS = int(os.environ.get('VAD_MAX_PAUSE_MS', '0'))
+
+# Audio clean-up applied to the decoded speech
+DSP_MAX_GAIN = float(os.environ.get('DSP_MAX_GAIN', '7'))
+DSP_TARGET_DB = float(os.environ.get('DSP_TARGET_DB', '-3'))
+DSP_RELEASE_SECONDS = float(os.environ.get('DSP_RELEASE_SECONDS', '1'))
+DSP_HIGHPASS_HZ = float(os.environ.get('DSP_HIGHPASS_HZ', '0'))
+DSP_DC_REMOVAL = os.environ.get('DSP_DC_REMOVAL', 'true').lower() in ('true', '1', 't', 'yes')
+DSP_BLOCK_MS = int(os.environ.get('DSP_BLOCK_MS', '100'))
+
+# Maximum number of idle Speex decoders kept for reuse
+SPEEX_DECODER_POOL_SIZE = int(os.environ.get('SPEEX_DECODER_POOL_SIZE', '16'))
+
+# Circuit breakers: stop calling a provider that keeps failing or is too slow
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get('CIRCUIT_BREAKER_FAILURES', '5'))
+CIRCUIT_BREAKER_SLOW_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_SLOW_SECONDS', '0'))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get('CIRCUIT_BREAKER_RESET_SECONDS', '30'))
+CIRCUIT_BREAKER_HALF_OPEN_REQUESTS = int(os.environ.get('CIRCUIT_BREAKER_HALF_OPEN_REQUESTS', '1'))
+
+# Hedging: race a second provider against a primary that is slower than usual
+HEDGE_PROVIDER = os.environ.get('HEDGE_PROVIDER', '').strip('"\'')
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '95'))
+HEDGE_INITIAL_DELAY = float(os.environ.get('HEDGE_INITIAL_DELAY', '3'))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', '0.5'))
+HEDGE_WINDOW = int(os.environ.get('HEDGE_WINDOW', '200'))
+
+# Time a request has to be answered in, counted from its arrival and including the upload (0 = no limit).
+# Clients may ask for less by sending the number of seconds they will wait in REQUEST_DEADLINE_HEADER
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', '60'))
+REQUEST_DEADLINE_HEADER = os.environ.get('REQUEST_DEADLINE_HEADER', '')
+
+# Admission control: how many requests each worker sends to a provider at once. Further
+# requests queue for a slot, and are asked to retry when the queue is full or the wait too long
+ADMISSION_GROQ_CONCURRENCY = int(os.environ.get('ADMISSION_GROQ_CONCURRENCY', '16'))
+ADMISSION_ELEVENLABS_CONCURRENCY = int(os.environ.get('ADMISSION_ELEVENLABS_CONCURRENCY', '16'))
+ADMISSION_WYOMING_CONCURRENCY = int(os.environ.get('ADMISSION_WYOMING_CONCURRENCY', '8'))
+ADMISSION_VOSK_CONCURRENCY = int(os.environ.get('ADMISSION_VOSK_CONCURRENCY', '4'))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', '16'))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '5'))
+
+# Transcript cache: answer a repeated upload of the same audio without transcribing it again
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get('TRANSCRIPT_CACHE_SIZE', '1000'))
+TRANSCRIPT_CACHE_MAX_MB = float(os.environ.get('TRANSCRIPT_CACHE_MAX_MB', '1'))
+TRANSCRIPT_CACHE_TTL = float(os.environ.get('TRANSCRIPT_CACHE_TTL', '300'))
+# Optional Redis shared by all workers and instances, e.g. redis://localhost:6379/0
+TRANSCRIPT_CACHE_REDIS_URL = os.environ.get('TRANSCRIPT_CACHE_REDIS_URL', '')
+
+# Wideband Speex decodes to 16kHz
+SPEEX_SAMPLE_RATE = 16000
+
+# Audio settings for the providers; other rates are resampled from the decoder output
+SAMPLE_RATE = int(os.environ.get('AUDIO_SAMPLE_RATE', '16000'))
 SAMPLE_WIDTH = 2
 SAMPLE_CHANNELS = 1
 
@@ -81,12 +198,175 @@ except Exception:
 
 logger.info(f"Using ASR API provider: {ASR_API_PROVIDER}")
 
+# Unknown providers have no admission limiter or breaker, use Vosk for them
+if ASR_API_PROVIDER not in ('elevenlabs', 'groq', 'wyoming-whisper', 'vosk'):
+    logger.error(f"Invalid ASR API provider: {ASR_API_PROVIDER}, falling back to Vosk")
+    ASR_API_PROVIDER = 'vosk'
+
 # Check if Wyoming is available when selected
 if ASR_API_PROVIDER == 'wyoming-whisper' and not HAS_WYOMING:
     logger.warning("Wyoming-whisper selected but Wyoming package not installed, falling back to Vosk")
     ASR_API_PROVIDER = 'vosk'
 
+# Check the hedge provider can actually be used
+if HEDGE_PROVIDER:
+    if HEDGE_PROVIDER not in ('elevenlabs', 'groq', 'wyoming-whisper', 'vosk'):
+        logger.warning(f"Invalid hedge provider: {HEDGE_PROVIDER}, hedging disabled")
+        HEDGE_PROVIDER = ''
+    elif HEDGE_PROVIDER in ('elevenlabs', 'groq') and not API_KEY:
+        logger.warning(f"Hedge provider {HEDGE_PROVIDER} requires an API key, hedging disabled")
+        HEDGE_PROVIDER = ''
+    elif HEDGE_PROVIDER == 'wyoming-whisper' and not HAS_WYOMING:
+        logger.warning("Hedge provider wyoming-whisper selected but Wyoming package not installed, hedging disabled")
+        HEDGE_PROVIDER = ''
+    elif HEDGE_PROVIDER == ASR_API_PROVIDER and HEDGE_PROVIDER != 'wyoming-whisper':
+        # Only Wyoming can hedge with itself, on another backend
+        logger.warning(f"Hedge provider is the same as the primary provider ({HEDGE_PROVIDER}), hedging disabled")
+        HEDGE_PROVIDER = ''
+
+# Languages routed to a provider this worker can't use keep the default one
+language_routes = {}
+for route_language, route in parse_routes(LANGUAGE_ROUTES).items():
+    if route.provider in ('elevenlabs', 'groq') and not API_KEY:
+        logger.warning(f"Language route {route_language}={route} requires an API key, ignoring it")
+    elif route.provider == 'wyoming-whisper' and not HAS_WYOMING:
+        logger.warning(f"Language route {route_language}={route} needs the Wyoming package, ignoring it")
+    else:
+        language_routes[route_language] = route
+language_router = LanguageRouter(language_routes, ASR_API_PROVIDER, hints=LANGUAGE_HINTS)
+if language_routes:
+    logger.info("Language routes: " + ', '.join(f"{language}={route}" for language, route in language_routes.items()))
+
+# One breaker per remote provider, per worker
+provider_breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=CIRCUIT_BREAKER_FAILURES,
+        latency_threshold=CIRCUIT_BREAKER_SLOW_SECONDS,
+        reset_timeout=CIRCUIT_BREAKER_RESET_SECONDS,
+        half_open_requests=CIRCUIT_BREAKER_HALF_OPEN_REQUESTS,
+    )
+    for name in ('elevenlabs', 'groq', 'wyoming-whisper')
+}
+
+# One admission limiter per provider, per worker
+admission = {
+    name: AdmissionLimiter(name, max_concurrency=max_concurrency, queue_size=ADMISSION_QUEUE_SIZE, timeout=ADMISSION_QUEUE_TIMEOUT)
+    for name, max_concurrency in (
+        ('elevenlabs', ADMISSION_ELEVENLABS_CONCURRENCY),
+        ('groq', ADMISSION_GROQ_CONCURRENCY),
+        ('wyoming-whisper', ADMISSION_WYOMING_CONCURRENCY),
+        ('vosk', ADMISSION_VOSK_CONCURRENCY),
+    )
+}
+
+hedger = None
+if HEDGE_PROVIDER:
+    hedger = Hedger(
+        percentile=HEDGE_PERCENTILE,
+        initial_delay=HEDGE_INITIAL_DELAY,
+        min_delay=HEDGE_MIN_DELAY,
+        window=HEDGE_WINDOW,
+    )
+    logger.info(f"Hedging slow requests with: {HEDGE_PROVIDER} (p{HEDGE_PERCENTILE:g} of recent latencies)")
+
+# Recent Vosk run times per second of audio, to tell whether a fallback can still make the deadline
+vosk_speed = LatencyTracker(window=50)
+
+transcript_cache = None
+if TRANSCRIPT_CACHE_SIZE > 0:
+    cache_backend = None
+    if TRANSCRIPT_CACHE_REDIS_URL:
+        if HAS_REDIS:
+            cache_backend = RedisCacheBackend(TRANSCRIPT_CACHE_REDIS_URL)
+        else:
+            logger.warning("TRANSCRIPT_CACHE_REDIS_URL is set but the redis package is not installed, caching in-process only")
+    transcript_cache = TranscriptCache(
+        max_entries=TRANSCRIPT_CACHE_SIZE,
+        max_bytes=int(TRANSCRIPT_CACHE_MAX_MB * 1024 * 1024),
+        ttl=TRANSCRIPT_CACHE_TTL,
+        backend=cache_backend,
+    )
+    logger.info(f"Transcript cache: {TRANSCRIPT_CACHE_SIZE} entries for {TRANSCRIPT_CACHE_TTL:g}s"
+                + (" (shared through Redis)" if cache_backend is not None else ""))
+
+if AUDIO_TRIM not in ('vad', 'fixed', 'none'):
+    logger.warning(f"Invalid AUDIO_TRIM: {AUDIO_TRIM}, using 'vad'")
+    AUDIO_TRIM = 'vad'
+
+# Each request decodes with its own Speex decoder (wideband), recycled between requests
+decoders = DecoderPool(lambda: SpeexDecoder(1), max_idle=SPEEX_DECODER_POOL_SIZE)
+if SPEEX_DECODER_POOL_SIZE and not decoders.reusable():
+    logger.warning("This Speex binding can't reset a decoder, so every request creates its own "
+                   "(SPEEX_DECODER_POOL_SIZE has no effect)")
+
+# Keep-alive connections to the cloud providers, shared by all requests in the worker
+http_client = HttpClient(pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT)
+
+# Upload encoders for the cloud providers
+groq_encoder = get_encoder(GROQ_AUDIO_FORMAT)
+elevenlabs_encoder = get_encoder(ELEVENLABS_AUDIO_FORMAT)
+
+# Vosk models are loaded once per worker (per language) and shared by all requests
+vosk_models = VoskModelRegistry(
+    VOSK_MODEL_PATH,
+    models_dir=VOSK_MODELS_DIR,
+    memory_budget=VOSK_MODEL_MEMORY_BUDGET_MB * 1024 * 1024,
+    pool_size=VOSK_RECOGNIZER_POOL_SIZE,
+    sample_rate=SAMPLE_RATE,
+)
+
+# Load the model at worker start when Vosk is the primary provider (or when asked to),
+# otherwise it is loaded lazily the first time a request falls back to Vosk
+VOSK_PRELOAD = os.environ.get('VOSK_PRELOAD', 'true' if ASR_API_PROVIDER == 'vosk' else 'false').lower() in ('true', '1', 't', 'yes')
+if VOSK_PRELOAD or VOSK_PROCESSES > 0:
+    vosk_models.preload()
+
+# Optionally run Vosk decoding in worker processes so it doesn't block the gevent hub.
+# The workers are forked after the preload above so they share the loaded model.
+vosk_pool = None
+if VOSK_PROCESSES > 0:
+    vosk_pool = VoskProcessPool(vosk_models, processes=VOSK_PROCESSES, max_queue=VOSK_QUEUE_SIZE, timeout=VOSK_JOB_TIMEOUT)
+    vosk_pool.start()
+
+def make_wyoming_balancer(hosts):
+    """Spread requests over Wyoming backends, keeping warm connections to each."""
+    return WyomingBalancer([
+        WyomingBackend(
+            WyomingConnectionPool(
+                host,
+                port,
+                size=WYOMING_POOL_SIZE,
+                connect_timeout=WYOMING_CONNECT_TIMEOUT,
+                health_interval=WYOMING_HEALTH_INTERVAL,
+            ),
+            max_concurrency=WYOMING_MAX_CONCURRENCY,
+            eject_failures=WYOMING_EJECT_FAILURES,
+            eject_seconds=WYOMING_EJECT_SECONDS,
+        )
+        for host, port in hosts
+    ], policy=WYOMING_LB_POLICY)
+
+wyoming_balancer = None
+if 'wyoming-whisper' in (ASR_API_PROVIDER, HEDGE_PROVIDER) or any(
+        route.provider == 'wyoming-whisper' and not route.hosts for route in language_routes.values()):
+    wyoming_balancer = make_wyoming_balancer(parse_hosts(WYOMING_HOSTS, WYOMING_PORT) or [(WYOMING_HOST, WYOMING_PORT)])
+    # Under ASGI the pools are started on the server's loop instead
+    if ASR_SERVER != 'asgi':
+        wyoming_balancer.start()
+    logger.info(f"Wyoming backends: {', '.join(b.name for b in wyoming_balancer.backends)} ({wyoming_balancer.policy})")
+
+# Languages routed to backends of their own get a balancer for them
+route_balancers = {}
+for route in language_routes.values():
+    if route.hosts and route.hosts not in route_balancers:
+        route_balancers[route.hosts] = make_wyoming_balancer(parse_hosts(route.hosts, WYOMING_PORT))
+        if ASR_SERVER != 'asgi':
+            route_balancers[route.hosts].start()
+        logger.info(f"Wyoming backends for {route}: {', '.join(b.name for b in route_balancers[route.hosts].backends)}")
+
 # Validate and initialize audio recording configuration
+recording_store = None
 if SAVE_RECORDINGS:
     if not AUDIO_RECORDINGS_DIR:
         logger.warning("SAVE_RECORDINGS is enabled but AUDIO_RECORDINGS_DIR is not set. Disabling audio recording.")
@@ -94,7 +374,14 @@ if SAVE_RECORDINGS:
     else:
         try:
             os.makedirs(AUDIO_RECORDINGS_DIR, exist_ok=True)
-            logger.info(f"Audio recording enabled. Saving to: {AUDIO_RECORDINGS_DIR} (max: {MAX_AUDIO_RECORDINGS} files)")
+            recording_store = RecordingStore(
+                AUDIO_RECORDINGS_DIR,
+                max_files=MAX_AUDIO_RECORDINGS,
+                max_bytes=int(MAX_AUDIO_RECORDINGS_MB * 1024 * 1024),
+                queue_size=RECORDINGS_QUEUE_SIZE,
+            )
+            logger.info(f"Audio recording enabled. Saving to: {AUDIO_RECORDINGS_DIR} (max: {MAX_AUDIO_RECORDINGS} files"
+                        + (f", {MAX_AUDIO_RECORDINGS_MB:g} MB)" if MAX_AUDIO_RECORDINGS_MB else ")"))
         except (OSError, PermissionError) as e:
             logger.error(f"Failed to create audio recordings directory '{AUDIO_RECORDINGS_DIR}': {e}")
             logger.error("Disabling audio recording.")
@@ -102,6 +389,20 @@ if SAVE_RECORDINGS:
 else:
     logger.info("Audio recording disabled")
 
+def start_recordings(loop=None):
+    """Start saving recordings, or stop trying if their manifest can't be opened."""
+    global recording_store, SAVE_RECORDINGS
+    try:
+        recording_store.start(loop)
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Failed to open the recordings manifest in '{AUDIO_RECORDINGS_DIR}': {e}")
+        logger.error("Disabling audio recording.")
+        recording_store = None
+        SAVE_RECORDINGS = False
+
+if recording_store is not None and ASR_SERVER != 'asgi':
+    start_recordings()
+
 
 # We know gunicorn does this, but it doesn't *say* it does this, so we must signal it manually.
 @app.before_request
@@ -109,54 +410,151 @@ def handle_chunking():
     request.environ['wsgi.input_terminated'] = 1
 
 
-def parse_chunks(stream):
-    boundary = b'--' + request.headers['content-type'].split(';')[1].split('=')[1].encode('utf-8').strip()  # super lazy/brittle parsing.
-    this_frame = b''
-    while True:
-        content = stream.read(4096)
-        this_frame += content
-        end = this_frame.find(boundary)
-        if end > -1:
-            frame = this_frame[:end]
-            this_frame = this_frame[end + len(boundary):]
-            if frame != b'':
-                try:
-                    header, content = frame.split(b'\r\n\r\n', 1)
-                except ValueError:
-                    continue
-                yield content[:-2]
-        if content == b'':
-            print("End of input.")
-            break
-
-def elevenlabs_transcribe(wav_buffer):
+def get_request_language():
+    """
+    Work out the dictation language of the current request.
+
+    Returns:
+        A lowercase locale such as 'en-us', or None if the host doesn't carry one.
+    """
+    return language_from_host(request.host)
+
+
+def language_from_host(host):
+    """
+    Rebble clients reach us as ``<token>-<lang>-<country>.asr.rebble.io``, so the
+    locale is carried in the first label of the host name.
+
+    Returns:
+        A lowercase locale such as 'en-us', or None if the host doesn't carry one.
+    """
+    label = host.split('.', 1)[0]
+    try:
+        _, language = label.split('-', 1)
+    except ValueError:
+        return None
+    return normalize_locale(language)
+
+
+def open_streams(provider, language, vosk_in_process=True):
+    """
+    Start the provider transcribing while the upload is still arriving, if it
+    can. Without ``vosk_in_process`` Vosk only streams to a worker process.
+
+    Returns:
+        A WyomingStream and a Vosk stream, either of which may be None.
+    """
+    if provider == 'wyoming-whisper':
+        return wyoming_whisper_stream(language), None
+    # Vosk needs a free recognizer
+    if provider == 'vosk' and VOSK_STREAMING and (vosk_in_process or vosk_pool is not None):
+        return None, vosk_stream(language)
+    return None, None
+
+def route_request(header, host_language):
+    """
+    Pick the dictation language and the provider of a request once its
+    header parts have arrived. The language the watch sends in them wins over
+    the one in the host name.
+
+    Returns:
+        The language (or None) and the provider name.
+    """
+    language = language_from_header_parts(header) or host_language
+    provider = language_router.route(language).provider
+    if DEBUG:
+        logger.debug(f"Request language: {language} (hint: {language_router.hint(language)}), provider: {provider}")
+    return language, provider
+
+
+def parse_chunks(stream, boundary):
+    # Parts are yielded as soon as they have been received
+    for part in iter_parts(stream, boundary):
+        yield part.body
+
+def decoded_audio(stream, boundary, decoder, timer=None, header=None):
+    """
+    Yield the decoded PCM of a request, block by block, as the upload arrives,
+    cleaned up by the DSP stage and with silence trimmed according to AUDIO_TRIM.
+
+    If a StageTimer is given, the time spent in each stage is added to it. If
+    a list is given as ``header``, the bodies of the Nuance header parts are
+    added to it before the first block is yielded.
+    """
+    def stage(name, iterable):
+        return timer.wrap(name, iterable) if timer is not None else iterable
+
+    chunks = parse_chunks(stream, boundary)
+    if AUDIO_TRIM == 'fixed':
+        frames = stage('upload', trim_frames(chunks, header))
+    else:
+        frames = stage('upload', skip_header_parts(chunks, header))
+
+    processor = AudioProcessor(
+        rate=SPEEX_SAMPLE_RATE,
+        output_rate=SAMPLE_RATE,
+        max_gain=DSP_MAX_GAIN,
+        target_db=DSP_TARGET_DB,
+        release_seconds=DSP_RELEASE_SECONDS,
+        highpass_hz=DSP_HIGHPASS_HZ,
+        dc_removal=DSP_DC_REMOVAL,
+        block_ms=DSP_BLOCK_MS,
+    )
+    pcm = stage('dsp', processor.process(stage('decode', decode_frames(frames, decoder))))
+    if AUDIO_TRIM == 'vad':
+        pcm = stage('vad', trim_silence(pcm, threshold_db=VAD_THRESHOLD_DB, padding_ms=VAD_PADDING_MS,
+                                        max_pause_ms=VAD_MAX_PAUSE_MS, frame_ms=DSP_BLOCK_MS))
+    return pcm
+
+
+def log_upload(upload, audio, encode_start):
+    upload_size = upload[1].seek(0, io.SEEK_END)
+    upload[1].seek(0)
+    logger.debug(f"Uploading {upload[0]}: {upload_size} bytes ({len(audio)} bytes of PCM), encoded in {time.time() - encode_start:.3f}s")
+
+def elevenlabs_request(audio, language=None):
+    """
+    Build an ElevenLabs transcription request, in the request language if
+    it is known (see ``LanguageRouter``).
+
+    Returns:
+        The URL and the files, form data and headers to post to it
+    """
+    files = {
+        "file": elevenlabs_encoder.encode(audio)
+    }
+    data = {
+        "model_id": language_router.model('elevenlabs', language) or ELEVENLABS_MODEL,
+        "tag_audio_events": "false",
+        "timestamps_granularity": "none"
+    }
+    hint = language_router.hint(language)
+    if hint:
+        data["language_code"] = hint
+    headers = {
+        "xi-api-key": API_KEY
+    }
+    return ELEVENLABS_API_URL, files, data, headers
+
+def elevenlabs_transcribe(audio, language=None):
     try:
         if DEBUG:
             logger.debug("Starting ElevenLabs transcription")
             api_start_time = time.time()
 
         # Create transcription via the ElevenLabs API
-        TRANSCIPTION_URL = "https://api.elevenlabs.io/v1/speech-to-text"
-
-        files = {
-            "file": ("audio.wav", wav_buffer, "audio/wav")
-        }
-        data = {
-            "model_id": "scribe_v1",
-            "tag_audio_events": "false",
-            "timestamps_granularity": "none"
-        }
-        headers = {
-            "xi-api-key": API_KEY
-        }
-
-        response_api = requests.post(TRANSCIPTION_URL, files=files, data=data, headers=headers)
+        url, files, data, headers = elevenlabs_request(audio, language)
+        if DEBUG:
+            log_upload(files["file"], audio, api_start_time)
+
+        response_api = http_client.post(url, files=files, data=data, headers=headers)
         response_api.raise_for_status()
         transcription = response_api.json()
 
         if DEBUG:
             api_time = time.time() - api_start_time
             logger.debug(f"ElevenLabs API request completed in {api_time:.3f}s")
+            logger.debug(f"HTTP client: {http_client.stats()}")
 
         return transcription.get("text", "")
 
@@ -164,33 +562,48 @@ def elevenlabs_transcribe(wav_buffer):
         logger.error(f"ElevenLabs transcription error: {e}")
         return None
 
-def groq_transcribe(wav_buffer):
+def groq_request(audio, language=None):
+    """
+    Build a Groq transcription request, in the request language if it is
+    known (see ``LanguageRouter``).
+
+    Returns:
+        The URL and the files, form data and headers to post to it
+    """
+    files = {
+        "file": groq_encoder.encode(audio)
+    }
+    data = {
+        "model": language_router.model('groq', language) or GROQ_MODEL,
+        "response_format": "json"
+    }
+    hint = language_router.hint(language)
+    if hint:
+        data["language"] = hint
+    headers = {
+        "Authorization": f"Bearer {API_KEY}"
+    }
+    return GROQ_API_URL, files, data, headers
+
+def groq_transcribe(audio, language=None):
     try:
         if DEBUG:
             logger.debug("Starting Groq transcription")
             api_start_time = time.time()
 
         # Create transcription via the Groq API
-        TRANSCIPTION_URL = "https://api.groq.com/openai/v1/audio/transcriptions"
-
-        files = {
-            "file": ("audio.wav", wav_buffer, "audio/wav")
-        }
-        data = {
-            "model": "whisper-large-v3",
-            "response_format": "json"
-        }
-        headers = {
-            "Authorization": f"Bearer {API_KEY}"
-        }
-
-        response_api = requests.post(TRANSCIPTION_URL, files=files, data=data, headers=headers)
+        url, files, data, headers = groq_request(audio, language)
+        if DEBUG:
+            log_upload(files["file"], audio, api_start_time)
+
+        response_api = http_client.post(url, files=files, data=data, headers=headers)
         response_api.raise_for_status()
         transcription = response_api.json()
 
         if DEBUG:
             api_time = time.time() - api_start_time
             logger.debug(f"Groq API request completed in {api_time:.3f}s")
+            logger.debug(f"HTTP client: {http_client.stats()}")
 
         return transcription.get("text", "")
 
@@ -198,96 +611,70 @@ def groq_transcribe(wav_buffer):
         logger.error(f"Groq transcription error: {e}")
         return None
 
-def wyoming_whisper_transcribe(wav_buffer):
-    try:
-        if not HAS_WYOMING:
-            logger.error("Wyoming package not installed, cannot use wyoming-whisper")
-            return None
-
-        if DEBUG:
-            logger.debug(f"Starting Wyoming-whisper transcription")
-            logger.debug(f"Wyoming host: {WYOMING_HOST}, port: {WYOMING_PORT}")
-            wyoming_start_time = time.time()
+def wyoming_balancer_for(language):
+    """The balancer over the Wyoming backends for requests in language."""
+    route = language_router.route(language)
+    if route.provider == 'wyoming-whisper' and route.hosts:
+        return route_balancers[route.hosts]
+    return wyoming_balancer
 
-        # Reset buffer position and read the audio data
-        wav_buffer.seek(0)
+def wyoming_whisper_stream(language=None):
+    """
+    Open a Wyoming conversation that audio can be streamed into as it is
+    decoded, on the backends for the request language and with its hint.
 
-        # Parse the WAV file to get just the PCM data
-        with wave.open(wav_buffer, 'rb') as wav_file:
-            audio_data = wav_file.readframes(wav_file.getnframes())
-            if DEBUG:
-                logger.debug(f"Extracted {len(audio_data)} bytes of PCM data from WAV")
-
-        # Since we need to use asyncio, we need to create and run an async function
-        async def process_with_wyoming():
-            connection_start_time = time.time() if DEBUG else 0
-            try:
-                # Connect to Wyoming service
-                async with AsyncTcpClient(WYOMING_HOST, WYOMING_PORT) as client:
-                    if DEBUG:
-                        connection_time = time.time() - connection_start_time
-                        logger.debug(f"Connected to Wyoming service in {connection_time:.3f}s")
+    Returns:
+        A started WyomingStream, or None if the circuit is open.
 
-                    # Set transcription language (using default as we don't have language info)
-                    await client.write_event(Transcribe(language=None).event())
+    Raises:
+        Overloaded: if every backend is at its concurrency limit.
+    """
+    breaker = provider_breakers['wyoming-whisper']
+    if not breaker.allow():
+        logger.warning("Circuit for wyoming-whisper is open, skipping it")
+        return None
 
-                    # Begin audio stream
-                    await client.write_event(
-                        AudioStart(
-                            rate=SAMPLE_RATE,
-                            width=SAMPLE_WIDTH,
-                            channels=SAMPLE_CHANNELS,
-                        ).event()
-                    )
+    balancer = wyoming_balancer_for(language)
+    backend = balancer.acquire()
+    if backend is None:
+        # The backends are busy, not failing: let the probe go without counting it
+        breaker.record(None)
+        raise Overloaded('wyoming-whisper', 'backends busy')
 
-                    if DEBUG:
-                        logger.debug(f"Sending {len(audio_data)} bytes to Wyoming service")
+    if DEBUG:
+        logger.debug(f"Starting Wyoming-whisper streaming transcription")
+        logger.debug(f"Wyoming backend: {backend.name}")
+
+    chunk_bytes = SAMPLE_RATE * SAMPLE_WIDTH * SAMPLE_CHANNELS * WYOMING_CHUNK_MS // 1000
+    return WyomingStream(
+        backend,
+        balancer=balancer,
+        breaker=breaker,
+        language=language_router.hint(language),
+        model=language_router.model('wyoming-whisper', language),
+        rate=SAMPLE_RATE,
+        width=SAMPLE_WIDTH,
+        channels=SAMPLE_CHANNELS,
+        chunk_bytes=chunk_bytes,
+    ).start()
+
+def wyoming_whisper_finish(stream):
+    """Finish a streamed Wyoming conversation and return its transcript, or None on failure."""
+    if stream is None:
+        return None
 
-                    # Send audio data
-                    chunk = AudioChunk(
-                        rate=SAMPLE_RATE,
-                        width=SAMPLE_WIDTH,
-                        channels=SAMPLE_CHANNELS,
-                        audio=audio_data,
-                    )
-                    await client.write_event(chunk.event())
+    try:
+        if DEBUG:
+            wyoming_start_time = time.time()
 
-                    # End audio stream
-                    await client.write_event(AudioStop().event())
+        result = stream.finish()
 
-                    if DEBUG:
-                        logger.debug("Waiting for transcription result")
-
-                    # Wait for transcription result
-                    while True:
-                        event = await client.read_event()
-                        if event is None:
-                            logger.error("Wyoming connection lost")
-                            return None
-
-                        if Transcript.is_type(event.type):
-                            transcript = Transcript.from_event(event)
-                            if DEBUG:
-                                logger.debug(f"Received transcript from Wyoming service: '{transcript.text}'")
-                            return transcript.text
-            except Exception as e:
-                logger.error(f"Wyoming transcription error: {e}")
-                if DEBUG:
-                    import traceback
-                    logger.debug(traceback.format_exc())
-                return None
-
-        # Run the async function in an event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        try:
-            result = loop.run_until_complete(process_with_wyoming())
-            if DEBUG:
-                wyoming_time = time.time() - wyoming_start_time
-                logger.debug(f"Wyoming-whisper transcription completed in {wyoming_time:.3f}s")
-            return result
-        finally:
-            loop.close()
+        if DEBUG:
+            wyoming_time = time.time() - wyoming_start_time
+            timings = ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in stream.timings.items())
+            logger.debug(f"Wyoming-whisper ({stream.backend.name}) sent {stream.bytes_sent} bytes, transcript ready {wyoming_time:.3f}s after upload ({timings})")
+            logger.debug(f"Wyoming backends: {stream.balancer.stats()}")
+        return result
 
     except Exception as e:
         logger.error(f"Wyoming-whisper transcription error: {e}")
@@ -296,279 +683,217 @@ def wyoming_whisper_transcribe(wav_buffer):
             logger.debug(traceback.format_exc())
         return None
 
-def vosk_transcribe(wav_buffer):
+def wyoming_whisper_transcribe(audio, language=None):
     try:
-        if DEBUG:
-            logger.debug("Starting Vosk transcription")
-            vosk_start_time = time.time()
-
-        from vosk import Model, KaldiRecognizer
-        import json
-
-        # Check if model directory exists
-        model_path = os.environ.get('VOSK_MODEL_PATH', '/code/model')
-        if not os.path.exists(model_path):
-            logger.error(f"Vosk model directory not found at {model_path}")
-            return None
-
-        # Check for model files
-        model_files = os.listdir(model_path)
-        if DEBUG:
-            logger.debug(f"Files in model directory: {model_files}")
-
-        required_files = ['am', 'conf', 'ivector']
-        missing_files = [f for f in required_files if not any(f in file for file in model_files)]
-
-        if missing_files:
-            logger.error(f"Missing required Vosk model files: {missing_files}")
+        if not HAS_WYOMING:
+            logger.error("Wyoming package not installed, cannot use wyoming-whisper")
             return None
 
-        try:
-            # Initialize model
-            model_init_start = time.time() if DEBUG else 0
-            model = Model(model_path)
-            rec = KaldiRecognizer(model, 16000)
-
-            if DEBUG:
-                model_init_time = time.time() - model_init_start
-                logger.debug(f"Vosk model initialized in {model_init_time:.3f}s")
-
-            # Reset buffer position
-            wav_buffer.seek(0)
-            # Read the WAV data
-            wav_data = wav_buffer.read()
-
-            if DEBUG:
-                logger.debug(f"Processing {len(wav_data)} bytes with Vosk")
-                process_start_time = time.time()
-
-            # Process audio
-            if len(wav_data) > 0:
-                if rec.AcceptWaveform(wav_data):
-                    result = json.loads(rec.Result())
-                else:
-                    result = json.loads(rec.FinalResult())
-
-                if DEBUG:
-                    process_time = time.time() - process_start_time
-                    logger.debug(f"Vosk processing completed in {process_time:.3f}s")
-                    logger.debug(f"Vosk result: {result}")
-
-                transcript = result.get("text", "")
-
-                if DEBUG:
-                    vosk_total_time = time.time() - vosk_start_time
-                    logger.debug(f"Vosk transcription completed in {vosk_total_time:.3f}s")
-
-                return transcript
-            return ""
-
-        except Exception as inner_e:
-            logger.error(f"Failed to initialize Vosk model: {inner_e}")
-            if DEBUG:
-                import traceback
-                logger.debug(traceback.format_exc())
+        stream = wyoming_whisper_stream(language)
+        if stream is None:
             return None
+        # Wyoming takes raw PCM, so the audio is sent straight from the buffer
+        stream.write(audio.pcm)
+        return wyoming_whisper_finish(stream)
 
     except Exception as e:
-        logger.error(f"Vosk transcription error: {e}")
+        logger.error(f"Wyoming-whisper transcription error: {e}")
         if DEBUG:
             import traceback
             logger.debug(traceback.format_exc())
         return None
 
-def save_audio_recording(wav_buffer, transcript):
-    """
-    Save audio recording and transcript to disk with automatic rotation.
-
-    Args:
-        wav_buffer: BytesIO object containing the WAV file
-        transcript: The transcribed text string
-    """
+def vosk_transcribe(audio, language=None, deadline=None):
     try:
-        # Generate timestamp-based filename
-        timestamp = datetime.now().strftime('recording_%Y%m%d_%H%M%S')
-        wav_filename = f"{timestamp}.wav"
-        txt_filename = f"{timestamp}.txt"
+        started = time.time()
+        if DEBUG:
+            logger.debug(f"Starting Vosk transcription (language: {language or 'default'})")
+            vosk_start_time = time.time()
 
-        wav_path = os.path.join(AUDIO_RECORDINGS_DIR, wav_filename)
-        txt_path = os.path.join(AUDIO_RECORDINGS_DIR, txt_filename)
+        # Vosk takes raw PCM
+        pcm = audio.pcm
 
-        # Save WAV file
-        try:
-            wav_buffer.seek(0)
-            with open(wav_path, 'wb') as f:
-                f.write(wav_buffer.read())
+        if len(pcm) == 0:
+            return ""
 
+        if DEBUG:
+            logger.debug(f"Processing {len(pcm)} bytes with Vosk")
+            process_start_time = time.time()
+
+        if vosk_pool is not None:
+            # Decode in a worker process; this only waits on a pipe so other greenlets keep running
+            transcript = vosk_pool.transcribe(pcm, language, deadline)
+            if transcript is not None:
+                vosk_speed.record((time.time() - started) / max(audio.duration, 0.1))
             if DEBUG:
-                wav_size = os.path.getsize(wav_path)
-                logger.debug(f"Saved audio recording: {wav_path} ({wav_size} bytes)")
-        except (IOError, OSError) as e:
-            logger.error(f"Failed to save WAV file '{wav_path}': {e}")
-            return
+                process_time = time.time() - process_start_time
+                logger.debug(f"Vosk worker processing completed in {process_time:.3f}s")
+                logger.debug(f"Vosk worker pool: {vosk_pool.stats()}")
+            return transcript
+
+        # Models are loaded once per worker; this only blocks the first time a language is used
+        loaded = vosk_models.get(language)
+        if loaded is None:
+            return None
 
-        # Save transcript file
-        try:
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(transcript)
+        # Process audio with a recognizer borrowed from the pool
+        segments = []
+        with loaded.recognizer() as rec:
+            accept(rec, bytes(pcm), segments)
+            transcript = final_text(rec, segments)
 
-            if DEBUG:
-                logger.debug(f"Saved transcript: {txt_path}")
-        except (IOError, OSError) as e:
-            logger.error(f"Failed to save transcript file '{txt_path}': {e}")
+        if DEBUG:
+            process_time = time.time() - process_start_time
+            logger.debug(f"Vosk processing completed in {process_time:.3f}s")
+            logger.debug(f"Vosk result: {transcript}")
 
-        # Rotate old recordings if limit exceeded
-        try:
-            # Get all WAV files sorted by modification time (oldest first)
-            wav_files = []
-            for filename in os.listdir(AUDIO_RECORDINGS_DIR):
-                if filename.endswith('.wav'):
-                    filepath = os.path.join(AUDIO_RECORDINGS_DIR, filename)
-                    wav_files.append((filepath, os.path.getmtime(filepath)))
-
-            # Sort by modification time
-            wav_files.sort(key=lambda x: x[1])
-
-            # Delete oldest files if we exceed the limit
-            files_to_delete = len(wav_files) - MAX_AUDIO_RECORDINGS
-            if files_to_delete > 0:
-                for i in range(files_to_delete):
-                    old_wav_path = wav_files[i][0]
-                    old_txt_path = old_wav_path.replace('.wav', '.txt')
-
-                    # Delete WAV file
-                    try:
-                        os.remove(old_wav_path)
-                        if DEBUG:
-                            logger.debug(f"Deleted old recording: {old_wav_path}")
-                    except OSError as e:
-                        logger.error(f"Failed to delete old WAV file '{old_wav_path}': {e}")
-
-                    # Delete corresponding TXT file if it exists
-                    if os.path.exists(old_txt_path):
-                        try:
-                            os.remove(old_txt_path)
-                            if DEBUG:
-                                logger.debug(f"Deleted old transcript: {old_txt_path}")
-                        except OSError as e:
-                            logger.error(f"Failed to delete old TXT file '{old_txt_path}': {e}")
+        vosk_speed.record((time.time() - started) / max(audio.duration, 0.1))
 
-            if DEBUG:
-                remaining_files = len(wav_files) - max(0, files_to_delete)
-                logger.debug(f"Audio recordings in directory: {remaining_files}/{MAX_AUDIO_RECORDINGS}")
-
-        except (IOError, OSError) as e:
-            logger.error(f"Failed to rotate old recordings: {e}")
+        if DEBUG:
+            vosk_total_time = time.time() - vosk_start_time
+            logger.debug(f"Vosk transcription completed in {vosk_total_time:.3f}s")
+            logger.debug(f"Vosk model cache: {vosk_models.stats()}")
 
-        # Reset buffer position for any subsequent use
-        wav_buffer.seek(0)
+        return transcript
 
     except Exception as e:
-        logger.error(f"Unexpected error in save_audio_recording: {e}")
+        logger.error(f"Vosk transcription error: {e}")
         if DEBUG:
             import traceback
             logger.debug(traceback.format_exc())
+        return None
 
-@app.route('/heartbeat')
-def heartbeat():
-    return 'asr'
-
-@app.route('/NmspServlet/', methods=["POST"])
-def recognise():
-    # Track total processing time
-    start_time = time.time()
-
-    if DEBUG:
-        logger.debug(f"Received request from: {request.remote_addr}")
-        logger.debug(f"Request headers: {dict(request.headers)}")
-
-    stream = request.stream
-
-    chunks = list(parse_chunks(stream))
-    chunks = chunks[3:]
-    pcm_data = bytearray()
-
-    if len(chunks) > 15:
-        chunks = chunks[12:-3]
-
-    if DEBUG:
-        logger.debug(f"Received {len(chunks)} audio chunks")
+def vosk_stream(language=None):
+    """
+    Start recognising a dictation with Vosk while it is uploaded, in a worker
+    process if there is a pool, otherwise in this one.
 
-    chunk_process_start = time.time()
-    for i, chunk in enumerate(chunks):
-        decoded = decoder.decode(chunk)
-        # Boosting the audio volume
-        decoded = audioop.mul(decoded, 2, 7)
-        # Directly append decoded audio bytes
-        pcm_data.extend(decoded)
+    Returns:
+        A VoskStream or VoskPoolStream, or None if no recognizer is free right
+        now (or the model is unavailable); the dictation is then transcribed
+        once the upload is complete.
+    """
+    block_bytes = SAMPLE_RATE * SAMPLE_WIDTH * SAMPLE_CHANNELS * VOSK_STREAM_BLOCK_MS // 1000
+    try:
+        if vosk_pool is not None:
+            return vosk_pool.stream(language, block_bytes=block_bytes)
+        loaded = vosk_models.get(language)
+        if loaded is None:
+            return None
+        # Waiting for a recognizer here would hold up the upload, so only a free one will do
+        return VoskStream(loaded, loaded.acquire(timeout=0), block_bytes=block_bytes)
+    except queue.Empty:
+        return None
+    except Exception as e:
+        logger.error(f"Vosk streaming error: {e}")
+        return None
 
+def vosk_stream_finish(stream, deadline=None):
+    """Get the transcript of a dictation recognised during the upload (see ``vosk_stream()``)."""
     if DEBUG:
-        chunk_process_time = time.time() - chunk_process_start
-        logger.debug(f"Processed {len(chunks)} chunks in {chunk_process_time:.3f}s")
-        logger.debug(f"PCM data size: {len(pcm_data)} bytes")
-
-    # Create WAV file in memory
-    wav_start_time = time.time()
-    wav_buffer = io.BytesIO()
-    with wave.open(wav_buffer, 'wb') as wav_file:
-        wav_file.setnchannels(1)
-        wav_file.setsampwidth(2)
-        wav_file.setframerate(16000)
-        wav_file.writeframes(pcm_data)
-
-    wav_buffer.seek(0)
-    wav_size = wav_buffer.getbuffer().nbytes
-
+        if isinstance(stream, VoskStream):
+            logger.debug(f"Vosk partial result: '{stream.partial()}' ({stream.bytes_fed} bytes decoded in {stream.decode_time:.3f}s)")
+        else:
+            logger.debug(f"Vosk worker received {stream.bytes_sent} bytes during the upload")
+        finish_start = time.time()
+    if isinstance(stream, VoskStream):
+        transcript = stream.finish()
+    else:
+        transcript = stream.finish(deadline)
     if DEBUG:
-        wav_process_time = time.time() - wav_start_time
-        logger.debug(f"Created WAV file in {wav_process_time:.3f}s")
-        logger.debug(f"WAV file size: {wav_size} bytes")
-        logger.debug(f"Audio duration: ~{len(pcm_data)/16000/2:.2f}s at 16kHz")
+        logger.debug(f"Vosk streaming transcription finished {time.time() - finish_start:.3f}s after the upload")
+    return transcript
 
-    # Initialize transcript variable
-    transcript = None
-
-    logger.info(f"Using ASR API provider: {ASR_API_PROVIDER}")
-
-    # Track transcription time
-    transcription_start = time.time()
+def transcribe_with(provider, audio, language, deadline=None):
+    """
+    Transcribe with one provider.
 
-    if ASR_API_PROVIDER == 'elevenlabs':
+    Args:
+        provider: The provider name, as in ASR_API_PROVIDER
+        audio: PcmBuffer holding the decoded audio
+        language: The request language; Vosk picks its model by it, the others
+            are told it (see ``LanguageRouter``)
+        deadline: When the request has to be answered by (as time.time()), or None.
+            Vosk gives up on its job then. Calls to the other providers are
+            cancelled by the caller instead (see ``deadline.enforce()``), so a
+            short deadline isn't counted against them by their circuit breakers.
+
+    Returns:
+        The transcript text, or None on failure
+    """
+    if provider == 'elevenlabs':
         if not API_KEY:
             logger.error("ElevenLabs requires an API key, falling back to Vosk")
-            transcript = vosk_transcribe(wav_buffer)
-        else:
-            transcript = elevenlabs_transcribe(wav_buffer)
-    elif ASR_API_PROVIDER == 'groq':
+            return vosk_transcribe(audio, language, deadline)
+        return provider_breakers['elevenlabs'].call(elevenlabs_transcribe, audio, language)
+    elif provider == 'groq':
         if not API_KEY:
             logger.error("Groq requires an API key, falling back to Vosk")
-            transcript = vosk_transcribe(wav_buffer)
-        else:
-            transcript = groq_transcribe(wav_buffer)
-    elif ASR_API_PROVIDER == 'wyoming-whisper':
-        transcript = wyoming_whisper_transcribe(wav_buffer)
-        if transcript is None:
-            logger.error("Wyoming-whisper transcription failed, falling back to Vosk")
-            transcript = vosk_transcribe(wav_buffer)
-    elif ASR_API_PROVIDER == 'vosk':
-        transcript = vosk_transcribe(wav_buffer)
+            return vosk_transcribe(audio, language, deadline)
+        return provider_breakers['groq'].call(groq_transcribe, audio, language)
+    elif provider == 'wyoming-whisper':
+        return wyoming_whisper_transcribe(audio, language)
+    elif provider == 'vosk':
+        return vosk_transcribe(audio, language, deadline)
     else:
-        logger.error(f"Invalid ASR API provider: {ASR_API_PROVIDER}, falling back to Vosk")
-        transcript = vosk_transcribe(wav_buffer)
+        logger.error(f"Invalid ASR API provider: {provider}, falling back to Vosk")
+        return vosk_transcribe(audio, language, deadline)
 
-    transcription_time = time.time() - transcription_start
+def transcribe_admitted(provider, audio, language, deadline=None):
+    """``transcribe_with()`` once the provider has a free slot; raises Overloaded if it turns the request away."""
+    with admission[provider].slot():
+        return transcribe_with(provider, audio, language, deadline)
 
-    # Check if transcript is valid
-    if transcript is None:
-        logger.error("All transcription methods failed")
-        abort(500)
+def vosk_fits(audio, deadline):
+    """Whether Vosk can be expected to transcribe audio before deadline, judging by its recent runs."""
+    if deadline is None or len(vosk_speed) == 0:
+        return True
+    return vosk_speed.percentile(50) * audio.duration < remaining(deadline)
 
-    logger.info(f"Transcript: '{transcript}' (took {transcription_time:.3f}s)")
+def retry_response(error):
+    """
+    The QueryRetry response for a request turned away by admission control
+    (Overloaded) or out of time (DeadlineExceeded), with its metrics.
 
-    # Save audio recording if enabled
-    if SAVE_RECORDINGS and AUDIO_RECORDINGS_DIR:
-        save_audio_recording(wav_buffer, transcript)
+    Returns:
+        The response body and its Content-Type.
+    """
+    logger.warning(f"Asking the watch to retry: {error}")
+    if isinstance(error, DeadlineExceeded):
+        metrics.DEADLINE_EXCEEDED.labels(error.stage).inc()
+        metrics.REQUESTS.labels('deadline_exceeded').inc()
+        return nmsp_response('', retry_prompt=DEADLINE_PROMPT)
+    metrics.REQUESTS.labels('overloaded').inc()
+    return nmsp_response('', retry_prompt=OVERLOADED_PROMPT)
+
+def provider_health_payload():
+    """
+    Providers, circuit breaker, admission, HTTP connection, cache and recording
+    state of this worker, for /heartbeat/providers.
+    """
+    return {
+        'provider': ASR_API_PROVIDER,
+        'language_routes': {language: str(route) for language, route in language_routes.items()},
+        'breakers': {name: breaker.stats() for name, breaker in provider_breakers.items()},
+        'admission': {name: limiter.stats() for name, limiter in admission.items()},
+        # The ASGI app talks to the cloud providers through its own httpx client
+        'http_client': http_client.stats() if ASR_SERVER != 'asgi' else None,
+        'transcript_cache': transcript_cache.stats() if transcript_cache is not None else None,
+        'recordings': recording_store.stats() if recording_store is not None else None,
+    }
+
+# Shown on the watch when a request is turned away by admission control, or runs out of time
+OVERLOADED_PROMPT = "Sorry, dictation is busy right now. Please try again."
+DEADLINE_PROMPT = "Sorry, that took too long. Please try again."
+
+def nmsp_response(transcript, retry_prompt="Sorry, speech not recognized. Please try again."):
+    """
+    Build the Nuance-style multipart response for a transcript.
 
+    Returns:
+        The response body and its Content-Type. An empty transcript asks the
+        watch to retry, showing retry_prompt.
+    """
     words = []
     for word in transcript.split():
         words.append({
@@ -593,7 +918,7 @@ def recognise():
         payload = json.dumps({
             "Cause": 1,
             "Name": "AUDIO_INFO",
-            "Prompt": "Sorry, speech not recognized. Please try again."
+            "Prompt": retry_prompt
         })
         #print(f"[DEBUG] Payload for QueryRetry: {payload}")
 
@@ -604,15 +929,303 @@ def recognise():
     response_text = '\r\n' + parts.as_string().split("\n", 3)[3].replace('\n', '\r\n')
     if DEBUG:
         logger.debug(f"Final response text prepared with boundary: {parts.get_boundary()}")
+    return response_text, f'multipart/form-data; boundary={parts.get_boundary()}'
+
+
+@app.route('/heartbeat')
+def heartbeat():
+    return 'asr'
+
+@app.route('/heartbeat/providers')
+def provider_health():
+    """Circuit breaker state of each remote provider in this worker."""
+    return Response(json.dumps(provider_health_payload()), mimetype='application/json')
 
-    response = Response(response_text)
-    response.headers['Content-Type'] = f'multipart/form-data; boundary={parts.get_boundary()}'
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus metrics, added up over every worker when PROMETHEUS_MULTIPROC_DIR is set."""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+class ProviderCalls:
+    """
+    The provider functions a server calls for a dictation: plain functions
+    under gevent, coroutine functions under asyncio (see ``asr.asgi``).
+    """
+
+    def __init__(self, observe, transcribe, transcribe_admitted, wyoming_finish, vosk_finish):
+        self.observe = observe
+        self.transcribe = transcribe
+        self.transcribe_admitted = transcribe_admitted
+        self.wyoming_finish = wyoming_finish
+        self.vosk_finish = vosk_finish
+
+
+class Dictation:
+    """
+    One request to /NmspServlet/: its audio, language and provider, and the
+    decisions about how to transcribe it.
+
+    The gevent view (``recognise()``) and the asyncio one (``asr.asgi``) share
+    it, so they only differ in how they wait for the upload and the providers.
+    """
+
+    def __init__(self, start_time, language, content_length=None, deadline_header=None, vosk_in_process=True):
+        self.start_time = start_time
+        self.deadline = request_deadline(start_time, REQUEST_DEADLINE, deadline_header)
+        self.language = language
+        self.vosk_in_process = vosk_in_process
+        self.audio = PcmBuffer(estimate_pcm_size(content_length), rate=SAMPLE_RATE, width=SAMPLE_WIDTH, channels=SAMPLE_CHANNELS)
+        # The provider is picked once the header parts have given the dictation language
+        self.header = []
+        self.provider = None
+        self.wyoming_stream = None
+        self.recognizer_stream = None
+        self.hedged = False
+        self.answered_by = None
+        self.cache_entry = None
+        self.transcription_start = None
+
+    def _route(self):
+        self.language, self.provider = route_request(self.header, self.language)
+        self.wyoming_stream, self.recognizer_stream = open_streams(self.provider, self.language, self.vosk_in_process)
+
+    def write(self, decoded):
+        """Add a block of decoded audio to the request's PCM buffer and the providers listening to the upload."""
+        if self.provider is None:
+            # The header parts come first, so the language is known now. Start talking to
+            # Wyoming (or Vosk) right away so it can transcribe while the upload is arriving
+            self._route()
+        self.audio.write(decoded)
+        if self.wyoming_stream is not None:
+            self.wyoming_stream.write(decoded)
+        if self.recognizer_stream is not None:
+            self.recognizer_stream.write(decoded)
+
+    def uploaded(self, timer):
+        """The upload is complete; timer holds the time spent in each stage of the audio pipeline."""
+        if self.provider is None:
+            # No audio at all
+            self._route()
+        timer.observe()
+        metrics.AUDIO_SECONDS.inc(self.audio.duration)
+        logger.info(f"Using ASR API provider: {self.provider}")
+        self.transcription_start = time.time()
+
+    def close_streams(self):
+        if self.wyoming_stream is not None:
+            self.wyoming_stream.close()
+        if self.recognizer_stream is not None:
+            self.recognizer_stream.close()
+
+    def cached(self):
+        """The cached transcript of this audio, or None."""
+        if transcript_cache is None:
+            return None
+        # A retried upload decodes to the same PCM, so it can be answered from the cache
+        self.cache_entry = cache_key(self.audio.pcm, self.provider, self.language)
+        transcript = transcript_cache.get(self.cache_entry)
+        if DEBUG:
+            logger.debug(f"Transcript cache {'hit' if transcript is not None else 'miss'}: {transcript_cache.stats()}")
+        if transcript is not None:
+            self.cache_entry = None
+            self.close_streams()
+        return transcript
+
+    def _observe(self, calls, provider, fn, *args):
+        """
+        Make a provider call with ``calls.observe``, noting which provider
+        came up with the transcript (the first to, if a hedge raced it).
+        """
+        result = calls.observe(provider, fn, *args)
+        if inspect.isawaitable(result):
+            async def answered():
+                transcript = await result
+                if transcript is not None and self.answered_by is None:
+                    self.answered_by = provider
+                return transcript
+            return answered()
+        if result is not None and self.answered_by is None:
+            self.answered_by = provider
+        return result
+
+    def calls(self, calls):
+        """
+        The provider calls to transcribe with, made with the ProviderCalls given.
+
+        Returns:
+            The primary call, and the secondary call to hedge it with (or None
+            if the request isn't hedged). Both take no arguments.
+        """
+        provider = self.provider
+        if provider == 'wyoming-whisper':
+            # Wyoming has been receiving the audio during the upload, only the transcript is left
+            primary = lambda: self._observe(calls, provider, calls.wyoming_finish, self.wyoming_stream)
+        elif self.recognizer_stream is not None and not self.recognizer_stream.failed:
+            # So has Vosk, only the end of the audio is left to decode
+            primary = lambda: self._observe(calls, provider, calls.vosk_finish, self.recognizer_stream, self.deadline)
+        else:
+            if self.recognizer_stream is not None:
+                self.recognizer_stream.close()
+            primary = lambda: self._observe(calls, provider, calls.transcribe, provider, self.audio, self.language, self.deadline)
+
+        secondary = None
+        self.hedged = hedger is not None and (HEDGE_PROVIDER != provider or provider == 'wyoming-whisper')
+        if self.hedged:
+            # Providers only read the buffer, so both can use it at once. A
+            # Wyoming hedge on another backend shares the primary's slot:
+            # waiting on the limiter for a second one could deadlock
+            transcribe = calls.transcribe if HEDGE_PROVIDER == provider else calls.transcribe_admitted
+            secondary = lambda: self._observe(calls, HEDGE_PROVIDER, transcribe, HEDGE_PROVIDER,
+                                               self.audio, self.language, self.deadline)
+        return primary, secondary
+
+    def fallback(self, transcript, calls):
+        """
+        The Vosk call to make after the provider failed, or None if there is no need.
+
+        Raises:
+            DeadlineExceeded: if Vosk can't be expected to finish in time.
+        """
+        if transcript is not None or self.provider == 'vosk' or (self.hedged and HEDGE_PROVIDER == 'vosk'):
+            # A Vosk hedge has been tried already, even if the primary failed early
+            return None
+        logger.error(f"{self.provider} transcription failed, falling back to Vosk")
+        metrics.FALLBACKS.labels(self.provider).inc()
+        if not vosk_fits(self.audio, self.deadline):
+            raise DeadlineExceeded('fallback')
+        return lambda: self._observe(calls, 'vosk', calls.transcribe_admitted, 'vosk', self.audio, self.language, self.deadline)
+
+    def retry(self, error):
+        """
+        Give up on the request, turned away by admission control or out of
+        time; sending it elsewhere would only spread the overload, so the
+        watch retries instead.
+
+        Returns:
+            The response body and its Content-Type.
+        """
+        self.close_streams()
+        return retry_response(error)
+
+    def respond(self, transcript):
+        """
+        Finish the request with its transcript: keep it in the cache, save the
+        recording and record the metrics.
+
+        Returns:
+            The response body and its Content-Type, or None if transcription failed.
+        """
+        if transcript is None:
+            logger.error("All transcription methods failed")
+            metrics.REQUESTS.labels('failed').inc()
+            return None
+
+        # Empty transcripts aren't kept, the retry may well do better; nor are
+        # those of a fallback or hedge, or the retry would never reach the provider again
+        if transcript and self.cache_entry is not None and self.answered_by == self.provider:
+            transcript_cache.put(self.cache_entry, transcript)
+
+        logger.info(f"Transcript: '{transcript}' (took {time.time() - self.transcription_start:.3f}s)")
+
+        # Save audio recording if enabled; it is written in the background
+        if recording_store is not None:
+            recording_id = recording_store.save(self.audio, transcript)
+            if DEBUG:
+                logger.debug(f"Queued recording {recording_id}: {recording_store.stats()}")
 
-    # Log total processing time
-    total_time = time.time() - start_time
-    logger.info(f"Total processing time: {total_time:.3f}s")
+        response = nmsp_response(transcript)
+
+        # Log total processing time
+        total_time = time.time() - self.start_time
+        metrics.REQUESTS.labels('transcript' if transcript.strip() else 'no_speech').inc()
+        metrics.REQUEST_DURATION.observe(total_time)
+        logger.info(f"Total processing time: {total_time:.3f}s")
+        return response
+
+
+provider_calls = ProviderCalls(
+    observe=metrics.observe_provider,
+    transcribe=transcribe_with,
+    transcribe_admitted=transcribe_admitted,
+    wyoming_finish=wyoming_whisper_finish,
+    vosk_finish=vosk_stream_finish,
+)
+
+@app.route('/NmspServlet/', methods=["POST"])
+@metrics.IN_FLIGHT.track_inprogress()
+def recognise():
+    # Track total processing time
+    start_time = time.time()
 
     if DEBUG:
-        logger.debug("Sending response")
+        logger.debug(f"Received request from: {request.remote_addr}")
+        logger.debug(f"Request headers: {dict(request.headers)}")
+
+    boundary = parse_boundary(request.headers.get('Content-Type'))
+    if boundary is None:
+        logger.error(f"Request is not multipart: {request.headers.get('Content-Type')}")
+        abort(400)
+
+    dictation = Dictation(start_time, get_request_language(), request.content_length,
+                          request.headers.get(REQUEST_DEADLINE_HEADER) if REQUEST_DEADLINE_HEADER else None)
+    deadline = dictation.deadline
 
-    return response
\ No newline at end of file
+    # Frames are trimmed and decoded while the rest of the upload is still arriving,
+    # so the PCM is complete as soon as the last frame has been received
+    chunk_process_start = time.time()
+    chunk_count = 0
+    timer = metrics.StageTimer()
+    try:
+        with enforce(deadline, 'upload'), decoders.decoder() as decoder:
+            for decoded in decoded_audio(request.stream, boundary, decoder, timer, dictation.header):
+                # Decoded audio goes straight into the request's PCM buffer
+                dictation.write(decoded)
+                chunk_count += 1
+    except BaseException as e:
+        dictation.close_streams()
+        if not isinstance(e, (Overloaded, DeadlineExceeded)):
+            raise
+        response_text, content_type = dictation.retry(e)
+        return Response(response_text, content_type=content_type)
+
+    dictation.uploaded(timer)
+    audio = dictation.audio
+
+    if DEBUG:
+        chunk_process_time = time.time() - chunk_process_start
+        logger.debug(f"Received and decoded {chunk_count} audio chunks in {chunk_process_time:.3f}s")
+        logger.debug(f"PCM data size: {len(audio)} bytes")
+        logger.debug(f"Audio duration: ~{audio.duration:.2f}s at {SAMPLE_RATE} Hz")
+        logger.debug(f"Speex decoder pool: {decoders.stats()}")
+        logger.debug("Stage timings: " + ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in timer.durations().items()))
+
+    transcript = dictation.cached()
+    if transcript is None:
+        primary, secondary = dictation.calls(provider_calls)
+        try:
+            # Provider calls still running when time is up are cancelled
+            with enforce(deadline, 'transcription'), admission[dictation.provider].slot():
+                if secondary is not None:
+                    transcript = hedger.run(primary, secondary)
+                    if DEBUG:
+                        logger.debug(f"Hedging: {hedger.stats()}")
+                else:
+                    transcript = primary()
+
+            fallback = dictation.fallback(transcript, provider_calls)
+            if fallback is not None:
+                with enforce(deadline, 'fallback'):
+                    transcript = fallback()
+        except (Overloaded, DeadlineExceeded) as e:
+            response_text, content_type = dictation.retry(e)
+            return Response(response_text, content_type=content_type)
+
+    response = dictation.respond(transcript)
+    if response is None:
+        abort(500)
+
+    response_text, content_type = response
+    if DEBUG:
+        logger.debug("Sending response")
+    return Response(response_text, content_type=content_type)
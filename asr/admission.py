@@ -0,0 +1,146 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+import gevent.event
+
+from . import metrics
+
+logger = logging.getLogger('rebble-asr')
+
+
+class Overloaded(Exception):
+    """A provider turned a request away: its queue was full ('shed') or the wait ran out ('timeout')."""
+
+    def __init__(self, provider, reason):
+        super().__init__(f"{provider} is overloaded ({reason})")
+        self.provider = provider
+        self.reason = reason
+
+
+class AdmissionLimiter:
+    """
+    Bounds how many requests a provider works on at once.
+
+    Up to ``max_concurrency`` calls run at a time (0 = no limit). Further
+    requests wait in a FIFO queue for a free slot, for at most ``timeout``
+    seconds; when ``queue_size`` requests are already waiting, new ones are
+    shed straight away. Either way ``Overloaded`` is raised, so a burst is
+    answered quickly instead of piling up on the provider.
+
+    A slot freed by a finished call is handed straight to the longest-waiting
+    request, so a newcomer can't overtake the queue.
+    """
+
+    def __init__(self, name, max_concurrency=0, queue_size=32, timeout=5.0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    def _enter(self, make_waiter):
+        """Take a free slot, or return a waiter to wait on for one; raises Overloaded if the queue is full."""
+        with self._lock:
+            if not self.max_concurrency or (self.active < self.max_concurrency and not self._waiters):
+                self.active += 1
+                self.admitted += 1
+                return None
+            if len(self._waiters) >= self.queue_size:
+                self.shed += 1
+                metrics.ADMISSION_REJECTED.labels(self.name, 'shed').inc()
+                raise Overloaded(self.name, 'shed')
+            waiter = make_waiter()
+            self._waiters.append(waiter)
+            self.queued += 1
+        metrics.ADMISSION_QUEUE.labels(self.name).inc()
+        return waiter
+
+    def _granted(self, waiter, start):
+        """After waiting: True if the waiter was handed a slot, otherwise it leaves the queue."""
+        with self._lock:
+            granted = waiter.is_set()
+            if granted:
+                self.admitted += 1
+            else:
+                self._waiters.remove(waiter)
+        metrics.ADMISSION_QUEUE.labels(self.name).dec()
+        metrics.ADMISSION_WAIT.labels(self.name).observe(time.time() - start)
+        return granted
+
+    def _timed_out(self):
+        with self._lock:
+            self.timed_out += 1
+        metrics.ADMISSION_REJECTED.labels(self.name, 'timeout').inc()
+        logger.warning(f"No free {self.name} slot after {self.timeout:g}s, turning the request away")
+        raise Overloaded(self.name, 'timeout')
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # The slot passes to the next waiter, so active stays the same
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+    @contextmanager
+    def slot(self):
+        """Hold one of the provider's slots for the duration of the block, waiting for one if needed."""
+        start = time.time()
+        waiter = self._enter(gevent.event.Event)
+        if waiter is not None:
+            try:
+                waiter.wait(self.timeout)
+            except BaseException:
+                # Killed while waiting (e.g. a hedged request won): pass on a slot handed over meanwhile
+                if self._granted(waiter, start):
+                    self.release()
+                raise
+            if not self._granted(waiter, start):
+                self._timed_out()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self):
+        """Like ``slot()``, on an asyncio loop."""
+        start = time.time()
+        waiter = self._enter(asyncio.Event)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(waiter.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                if self._granted(waiter, start):
+                    self.release()
+                raise
+            if not self._granted(waiter, start):
+                self._timed_out()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_concurrency': self.max_concurrency,
+                'active': self.active,
+                'waiting': len(self._waiters),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'shed': self.shed,
+                'timed_out': self.timed_out,
+            }
@@ -0,0 +1,348 @@
+"""
+ASGI entry point: serves the dictation endpoint on a single asyncio loop.
+
+The WSGI app in ``asr`` runs under gunicorn's gevent worker, with everything
+monkey-patched. This one runs on any ASGI server instead:
+
+    ASR_SERVER=asgi uvicorn asr.asgi:app --host 0.0.0.0 --port 9999
+
+ASR_SERVER=asgi must be set so importing ``asr`` doesn't monkey-patch.
+Configuration, providers and the audio pipeline are the ones ``asr`` sets up.
+The request body is read from the ASGI receive channel as it arrives. Groq
+and ElevenLabs are called with httpx. Wyoming conversations run on the
+server's loop. Vosk and the recording writer run on threads.
+"""
+import time
+import json
+import asyncio
+import logging
+
+import httpx
+from greenlet import getcurrent, greenlet
+
+from . import (
+    ASR_SERVER, API_KEY, HAS_WYOMING, DEBUG, SAMPLE_RATE, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+    decoded_audio, decoders, language_from_host, provider_health_payload, provider_breakers,
+    elevenlabs_request, groq_request, wyoming_whisper_stream, vosk_transcribe, wyoming_balancer, hedger,
+    recording_store, start_recordings, metrics, admission, vosk_stream_finish, route_balancers, Dictation, ProviderCalls,
+    REQUEST_DEADLINE_HEADER,
+)
+from .admission import Overloaded
+from .deadline import DeadlineExceeded, enforce_async
+from .multipart import parse_boundary
+
+if ASR_SERVER != 'asgi':
+    raise RuntimeError("asr.asgi needs ASR_SERVER=asgi, otherwise importing asr monkey-patches for gevent")
+
+if HAS_WYOMING:
+    from . import wyoming_client
+
+logger = logging.getLogger('rebble-asr')
+if not DEBUG:
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Set up at startup, on the server's loop
+http_client = None
+
+_NEED_DATA = object()
+
+
+class ClientDisconnected(Exception):
+    """The watch went away before the upload was complete."""
+
+
+class _BodyStream:
+    """
+    File-like request body for the synchronous audio pipeline.
+
+    ``read()`` switches back to the request's task, which waits for the next
+    chunk of the body without blocking the loop and switches back with it.
+    """
+
+    def __init__(self, task):
+        self._task = task
+
+    def read(self, size=-1):
+        return self._task.switch(_NEED_DATA)
+
+
+async def decoded_audio_async(receive, boundary, decoder, timer=None, header=None):
+    """
+    Yield the decoded PCM of a request as the body arrives over ASGI.
+
+    The audio pipeline (``asr.decoded_audio``) is a chain of generators that
+    pull from a file-like stream. It runs in a greenlet on this thread; when
+    it needs more of the body it switches back here to await it, so all of it
+    runs on the loop without threads or monkey-patching.
+    """
+    task = getcurrent()
+
+    def run():
+        for block in decoded_audio(_BodyStream(task), boundary, decoder, timer, header):
+            task.switch(block)
+
+    pipeline = greenlet(run)
+    ended = False
+    try:
+        value = pipeline.switch()
+        while not pipeline.dead:
+            if value is not _NEED_DATA:
+                yield value
+                value = pipeline.switch()
+                continue
+
+            data = b''
+            while not ended and not data:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    raise ClientDisconnected()
+                data = message.get('body', b'')
+                ended = not message.get('more_body', False)
+            # An empty read tells the parser the body has ended
+            value = pipeline.switch(data)
+    finally:
+        if not pipeline.dead:
+            pipeline.throw()
+
+
+async def cloud_transcribe(name, build_request, audio, language=None):
+    """Transcribe with Groq or ElevenLabs over the shared async HTTP client; None on failure."""
+    try:
+        if DEBUG:
+            logger.debug(f"Starting {name} transcription")
+            api_start_time = time.time()
+
+        url, files, data, headers = build_request(audio, language)
+        response_api = await http_client.post(url, files=files, data=data, headers=headers)
+        response_api.raise_for_status()
+        transcription = response_api.json()
+
+        if DEBUG:
+            logger.debug(f"{name} API request completed in {time.time() - api_start_time:.3f}s")
+
+        return transcription.get("text", "")
+
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"{name} transcription error: {e!r}")
+        return None
+
+
+async def wyoming_whisper_finish_async(stream):
+    """Finish a streamed Wyoming conversation and return its transcript, or None on failure."""
+    if stream is None:
+        return None
+
+    try:
+        if DEBUG:
+            wyoming_start_time = time.time()
+
+        result = await stream.finish_async()
+
+        if DEBUG:
+            timings = ', '.join(f"{stage} {seconds:.3f}s" for stage, seconds in stream.timings.items())
+            logger.debug(f"Wyoming-whisper ({stream.backend.name}) sent {stream.bytes_sent} bytes, transcript ready "
+                         f"{time.time() - wyoming_start_time:.3f}s after upload ({timings})")
+        return result
+
+    except Exception as e:
+        logger.error(f"Wyoming-whisper transcription error: {e}")
+        return None
+
+
+async def vosk_transcribe_async(audio, language, deadline=None):
+    # Vosk decoding is a long native call (or a wait on a worker process), so it runs on a thread
+    return await asyncio.get_running_loop().run_in_executor(None, vosk_transcribe, audio, language, deadline)
+
+
+async def vosk_stream_finish_async(stream, deadline=None):
+    return await asyncio.get_running_loop().run_in_executor(None, vosk_stream_finish, stream, deadline)
+
+
+async def transcribe_with_async(provider, audio, language, deadline=None):
+    """Like ``asr.transcribe_with()``, on the loop."""
+    if provider == 'elevenlabs':
+        if not API_KEY:
+            logger.error("ElevenLabs requires an API key, falling back to Vosk")
+            return await vosk_transcribe_async(audio, language, deadline)
+        return await provider_breakers['elevenlabs'].call_async(cloud_transcribe, 'ElevenLabs', elevenlabs_request, audio, language)
+    elif provider == 'groq':
+        if not API_KEY:
+            logger.error("Groq requires an API key, falling back to Vosk")
+            return await vosk_transcribe_async(audio, language, deadline)
+        return await provider_breakers['groq'].call_async(cloud_transcribe, 'Groq', groq_request, audio, language)
+    elif provider == 'wyoming-whisper':
+        if not HAS_WYOMING:
+            logger.error("Wyoming package not installed, cannot use wyoming-whisper")
+            return None
+        stream = wyoming_whisper_stream(language)
+        if stream is None:
+            return None
+        stream.write(audio.pcm)
+        return await wyoming_whisper_finish_async(stream)
+    elif provider == 'vosk':
+        return await vosk_transcribe_async(audio, language, deadline)
+    else:
+        logger.error(f"Invalid ASR API provider: {provider}, falling back to Vosk")
+        return await vosk_transcribe_async(audio, language, deadline)
+
+
+async def transcribe_admitted_async(provider, audio, language, deadline=None):
+    """Like ``asr.transcribe_admitted()``, on the loop."""
+    async with admission[provider].slot_async():
+        return await transcribe_with_async(provider, audio, language, deadline)
+
+
+async def respond(send, status, body, content_type='text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+provider_calls = ProviderCalls(
+    observe=metrics.observe_provider_async,
+    transcribe=transcribe_with_async,
+    transcribe_admitted=transcribe_admitted_async,
+    wyoming_finish=wyoming_whisper_finish_async,
+    vosk_finish=vosk_stream_finish_async,
+)
+
+
+async def recognise(scope, receive, send):
+    # Track total processing time
+    start_time = time.time()
+
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    if DEBUG:
+        logger.debug(f"Received request from: {scope.get('client')}")
+        logger.debug(f"Request headers: {headers}")
+
+    boundary = parse_boundary(headers.get('content-type'))
+    if boundary is None:
+        logger.error(f"Request is not multipart: {headers.get('content-type')}")
+        await respond(send, 400, b'Bad Request')
+        return
+
+    content_length = headers.get('content-length')
+    if content_length is not None and not content_length.isdigit():
+        logger.error(f"Invalid Content-Length: {content_length!r}")
+        await respond(send, 400, b'Bad Request')
+        return
+
+    # Vosk only streams to a worker process; decoding here would hold up the loop
+    dictation = Dictation(start_time, language_from_host(headers.get('host', '')),
+                          int(content_length) if content_length else None,
+                          headers.get(REQUEST_DEADLINE_HEADER.lower()) if REQUEST_DEADLINE_HEADER else None,
+                          vosk_in_process=False)
+    deadline = dictation.deadline
+
+    timer = metrics.StageTimer()
+    try:
+        with decoders.decoder() as decoder:
+            async with enforce_async(deadline, 'upload'):
+                async for decoded in decoded_audio_async(receive, boundary, decoder, timer, dictation.header):
+                    dictation.write(decoded)
+    except BaseException as e:
+        dictation.close_streams()
+        if not isinstance(e, (Overloaded, DeadlineExceeded)):
+            raise
+        response_text, content_type = dictation.retry(e)
+        await respond(send, 200, response_text.encode('utf-8'), content_type)
+        return
+
+    dictation.uploaded(timer)
+    if DEBUG:
+        logger.debug(f"PCM data size: {len(dictation.audio)} bytes, ~{dictation.audio.duration:.2f}s at {SAMPLE_RATE} Hz")
+
+    transcript = dictation.cached()
+    if transcript is None:
+        primary, secondary = dictation.calls(provider_calls)
+        try:
+            async with enforce_async(deadline, 'transcription'), admission[dictation.provider].slot_async():
+                if secondary is not None:
+                    transcript = await hedger.run_async(primary, secondary)
+                else:
+                    transcript = await primary()
+
+            fallback = dictation.fallback(transcript, provider_calls)
+            if fallback is not None:
+                async with enforce_async(deadline, 'fallback'):
+                    transcript = await fallback()
+        except (Overloaded, DeadlineExceeded) as e:
+            response_text, content_type = dictation.retry(e)
+            await respond(send, 200, response_text.encode('utf-8'), content_type)
+            return
+
+    response = dictation.respond(transcript)
+    if response is None:
+        await respond(send, 500, b'Internal Server Error')
+        return
+    response_text, content_type = response
+    await respond(send, 200, response_text.encode('utf-8'), content_type)
+
+
+async def startup():
+    global http_client
+    loop = asyncio.get_running_loop()
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    timeout = httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    metrics.clean_multiprocess_dir()
+    if wyoming_balancer is not None or route_balancers:
+        wyoming_client.use_loop(loop)
+    if wyoming_balancer is not None:
+        wyoming_balancer.start()
+    for balancer in route_balancers.values():
+        balancer.start()
+    if recording_store is not None:
+        start_recordings(loop)
+    logger.info("Serving on asyncio (ASGI)")
+
+
+async def shutdown():
+    if http_client is not None:
+        await http_client.aclose()
+    metrics.mark_dead()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    if path == '/heartbeat':
+        await respond(send, 200, b'asr')
+    elif path == '/heartbeat/providers':
+        await respond(send, 200, json.dumps(provider_health_payload()).encode(), 'application/json')
+    elif path == '/metrics':
+        body, content_type = metrics.render()
+        await respond(send, 200, body, content_type)
+    elif path == '/NmspServlet/':
+        if scope['method'] != 'POST':
+            await respond(send, 405, b'Method Not Allowed')
+            return
+        with metrics.IN_FLIGHT.track_inprogress():
+            try:
+                await recognise(scope, receive, send)
+            except ClientDisconnected:
+                logger.warning("Client disconnected before the upload was complete")
+    else:
+        await respond(send, 404, b'Not Found')
@@ -0,0 +1,340 @@
+import io
+import struct
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from .dsp import rms
+
+logger = logging.getLogger('rebble-asr')
+
+# The first parts of a Nuance request carry request data, not audio
+HEADER_PARTS = 3
+# On longer utterances the first frames are mostly the button press and the last few the release
+LEAD_IN_FRAMES = 12
+TAIL_FRAMES = 3
+# Only utterances with more than this many frames are trimmed
+MIN_TRIM_FRAMES = 15
+
+# Wideband Speex frames carry 20ms of audio
+FRAME_MS = 20
+
+# Most a buffer is sized up front from Content-Length: a minute of 16kHz 16-bit mono
+MAX_ESTIMATED_PCM = 16000 * 2 * 60
+
+
+def skip_header_parts(parts, header=None):
+    """
+    Yield the Speex frames of a request as they arrive, without the Nuance
+    header parts. If a list is given as ``header``, the header parts are
+    appended to it before the first frame is yielded.
+    """
+    parts = iter(parts)
+    for _ in range(HEADER_PARTS):
+        part = next(parts, None)
+        if part is None:
+            return
+        if header is not None:
+            header.append(part)
+    yield from parts
+
+
+def trim_frames(parts, header=None):
+    """
+    Yield the Speex frames of a request as they arrive, without the Nuance
+    header parts and, for utterances longer than MIN_TRIM_FRAMES, without the
+    lead-in and tail frames.
+
+    This matches slicing the complete list with ``[3:]`` and then ``[12:-3]``,
+    but only ever holds back MIN_TRIM_FRAMES + 1 frames until it knows the
+    utterance is long enough to trim, and TAIL_FRAMES frames after that.
+    """
+    parts = skip_header_parts(parts, header)
+
+    pending = deque()
+    trimming = False
+    for frame in parts:
+        pending.append(frame)
+        if not trimming:
+            if len(pending) <= MIN_TRIM_FRAMES:
+                continue
+            trimming = True
+            for _ in range(LEAD_IN_FRAMES):
+                pending.popleft()
+        while len(pending) > TAIL_FRAMES:
+            yield pending.popleft()
+
+    # Short utterances are kept whole; long ones lose the frames still held back
+    if not trimming:
+        yield from pending
+
+
+def decode_frames(frames, decoder):
+    """Speex-decode frames one at a time, yielding 16-bit PCM."""
+    for frame in frames:
+        yield decoder.decode(frame)
+
+
+def trim_silence(frames, threshold_db=-40.0, padding_ms=200, max_pause_ms=0, frame_ms=FRAME_MS):
+    """
+    Drop leading and trailing silence from blocks of PCM as they arrive.
+
+    Every block holds ``frame_ms`` of audio and is speech when its RMS level
+    reaches ``threshold_db`` (dBFS).
+    Up to ``padding_ms`` of silence is kept before the first and after the
+    last speech frame so word onsets and endings aren't clipped. If
+    ``max_pause_ms`` is set, pauses between speech longer than that are
+    shortened to it, keeping their start and end.
+
+    Leading frames are held back until speech starts and silent frames until
+    the next speech frame, so speech is passed on as soon as it is decoded. If
+    no frame reaches the threshold the audio is passed on untouched rather
+    than risk dropping a quiet utterance.
+    """
+    threshold = 32768 * 10 ** (threshold_db / 20.0)
+    padding = max(0, -(-padding_ms // frame_ms))
+    max_pause = max(0, max_pause_ms // frame_ms)
+
+    frames = iter(frames)
+    leading = []
+    for frame in frames:
+        if rms(frame) >= threshold:
+            break
+        leading.append(frame)
+    else:
+        yield from leading
+        return
+
+    if padding:
+        yield from leading[-padding:]
+    del leading
+    yield frame
+
+    silence = []
+    for frame in frames:
+        if rms(frame) < threshold:
+            silence.append(frame)
+            continue
+        if max_pause and len(silence) > max_pause:
+            head = max_pause // 2
+            silence = silence[:head] + silence[len(silence) - (max_pause - head):]
+        yield from silence
+        silence.clear()
+        yield frame
+
+    yield from silence[:padding]
+
+
+def wav_header(data_size, rate=16000, width=2, channels=1):
+    """Return the 44-byte header of a PCM WAV file holding data_size bytes of audio."""
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, rate, rate * width * channels, width * channels, width * 8,
+        b'data', data_size,
+    )
+
+
+class WavReader(io.RawIOBase):
+    """
+    Read-only file over a WAV header and a PCM buffer, without joining them.
+
+    Every reader has its own position, so several providers can read the
+    same audio at once.
+    """
+
+    def __init__(self, header, pcm):
+        super().__init__()
+        self._parts = (memoryview(header), pcm)
+        self._size = len(header) + len(pcm)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def _slices(self, size):
+        start, end = self._pos, min(self._size, self._pos + size)
+        for part in self._parts:
+            if start < len(part) and end > 0:
+                yield part[max(0, start):min(len(part), end)]
+            start -= len(part)
+            end -= len(part)
+
+    def readinto(self, b):
+        written = 0
+        for chunk in self._slices(len(b)):
+            b[written:written + len(chunk)] = chunk
+            written += len(chunk)
+        self._pos += written
+        return written
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size
+        data = b''.join(self._slices(size))
+        self._pos += len(data)
+        return data
+
+
+def estimate_pcm_size(content_length, max_size=MAX_ESTIMATED_PCM):
+    """
+    Estimate how much PCM an upload of content_length bytes decodes to.
+
+    A Speex frame arrives as roughly 70 bytes of audio and 150 bytes of part
+    headers and decodes to 640 bytes of PCM, so the PCM is about three times
+    the size of the upload. The estimate is capped at ``max_size``, since
+    Content-Length is up to the client; longer audio grows the buffer as it
+    arrives.
+
+    Returns:
+        The estimate in bytes, or None if the length isn't known.
+    """
+    if not content_length:
+        return None
+    return min(content_length * 3, max_size)
+
+
+class PcmBuffer:
+    """
+    The decoded audio of one request.
+
+    Frames are written into a single preallocated buffer, sized up front from
+    the upload where possible and doubled if it runs out, and consumers get
+    ``pcm``, a zero-copy view of the audio. Providers that want a file get
+    ``wav()``, which puts a WAV header in front of the same view on the fly
+    instead of building a WAV copy.
+    """
+
+    def __init__(self, capacity=None, rate=16000, width=2, channels=1):
+        self.rate = rate
+        self.width = width
+        self.channels = channels
+        # Ten seconds of audio when the size can't be estimated
+        self._buffer = bytearray(capacity or rate * width * channels * 10)
+        self._view = memoryview(self._buffer)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def _grow(self, needed):
+        buffer = bytearray(max(needed, 2 * len(self._buffer)))
+        buffer[:self._length] = self._view[:self._length]
+        self._view.release()
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+    def write(self, data):
+        end = self._length + len(data)
+        if end > len(self._buffer):
+            self._grow(end)
+        self._view[self._length:end] = data
+        self._length = end
+
+    @property
+    def pcm(self):
+        """The audio as a read-only memoryview of raw 16-bit PCM."""
+        return self._view[:self._length].toreadonly()
+
+    @property
+    def duration(self):
+        return self._length / (self.rate * self.width * self.channels)
+
+    def wav_header(self):
+        return wav_header(self._length, self.rate, self.width, self.channels)
+
+    def wav(self):
+        """A new file-like reader over the audio as a WAV file."""
+        return WavReader(self.wav_header(), self.pcm)
+
+
+class DecoderPool:
+    """
+    Gives every in-flight request its own Speex decoder.
+
+    Speex decoders carry state from one frame to the next, so a decoder must
+    never be shared by two requests at once. Decoders are reset and kept for
+    the next request instead of being allocated each time; up to ``max_idle``
+    idle decoders are kept. Decoders that can't be reset (the binding doesn't
+    expose it) are dropped after use rather than leaking one request's state
+    into the next; ``reusable()`` tells whether the factory's decoders can be
+    kept at all.
+    """
+
+    def __init__(self, factory, max_idle=16):
+        self.factory = factory
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.in_use = 0
+
+    def reusable(self):
+        """Whether decoders from the factory can be reset, and so kept for another request."""
+        decoder = self._acquire()
+        try:
+            return callable(getattr(decoder, 'reset', None))
+        finally:
+            self._release(decoder)
+
+    def _acquire(self):
+        with self._lock:
+            self.in_use += 1
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop()
+            self.created += 1
+        return self.factory()
+
+    def _release(self, decoder):
+        reset = getattr(decoder, 'reset', None)
+        recycle = False
+        if reset is not None:
+            try:
+                reset()
+                recycle = True
+            except Exception as e:
+                logger.warning(f"Discarding Speex decoder that failed to reset: {e}")
+
+        with self._lock:
+            self.in_use -= 1
+            if recycle and len(self._idle) < self.max_idle:
+                self._idle.append(decoder)
+            else:
+                self.discarded += 1
+
+    @contextmanager
+    def decoder(self):
+        """Borrow a decoder for the duration of one request."""
+        decoder = self._acquire()
+        try:
+            yield decoder
+        finally:
+            self._release(decoder)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+            }
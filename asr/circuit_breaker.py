@@ -0,0 +1,154 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger('rebble-asr')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider that keeps failing.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    ``allow()`` refuses every call, so requests go straight to the fallback
+    instead of waiting for another connection error or timeout. A call that
+    returns but takes longer than ``latency_threshold`` seconds (if set)
+    counts as a failure too.
+
+    Once ``reset_timeout`` seconds have passed the breaker is half-open: up
+    to ``half_open_requests`` trial calls are let through at a time. A
+    successful trial closes the breaker again, a failed one re-opens it.
+    """
+
+    def __init__(self, name, failure_threshold=5, latency_threshold=0.0, reset_timeout=30.0, half_open_requests=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_requests = half_open_requests
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.probes = 0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.rejected = 0
+        self.opened = 0
+
+    def allow(self):
+        """
+        Ask to make a call.
+
+        Returns:
+            True if the call may go ahead; it must then be reported with ``record()``.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = HALF_OPEN
+                self.probes = 0
+                logger.info(f"Circuit for {self.name} is half-open, trying a request")
+
+            if self.state == HALF_OPEN:
+                if self.probes >= self.half_open_requests:
+                    self.rejected += 1
+                    return False
+                self.probes += 1
+
+            self.calls += 1
+            return True
+
+    def record(self, ok, latency=0.0):
+        """
+        Report the outcome of an allowed call.
+
+        Args:
+            ok: Whether the call succeeded, or None if it was abandoned by the caller
+            latency: How long the call took, in seconds
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+            if ok is None:
+                return
+
+            if ok and self.latency_threshold and latency > self.latency_threshold:
+                self.slow_calls += 1
+                ok = False
+
+            if ok:
+                if self.state != CLOSED:
+                    logger.info(f"Circuit for {self.name} is closed again")
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                return
+
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                    logger.warning(f"Opening circuit for {self.name} for {self.reset_timeout:.0f}s "
+                                   f"after {self.consecutive_failures} failed or slow requests")
+                self.state = OPEN
+                self.opened_at = time.time()
+                self.consecutive_failures = 0
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn unless the breaker is open. fn signals failure by returning None.
+
+        Returns:
+            What fn returned, or None if the breaker refused the call.
+        """
+        if not self.allow():
+            logger.warning(f"Circuit for {self.name} is open, skipping it")
+            return None
+
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            # Cancelled (e.g. a hedged request won); provider errors are returned as None
+            self.record(None)
+            raise
+        self.record(result is not None, time.time() - start)
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Like ``call()``, for a coroutine function."""
+        if not self.allow():
+            logger.warning(f"Circuit for {self.name} is open, skipping it")
+            return None
+
+        start = time.time()
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException:
+            self.record(None)
+            raise
+        self.record(result is not None, time.time() - start)
+        return result
+
+    def stats(self):
+        with self._lock:
+            state = self.state
+            if state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                state = HALF_OPEN
+            return {
+                'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'calls': self.calls,
+                'failures': self.failures,
+                'slow_calls': self.slow_calls,
+                'rejected': self.rejected,
+                'opened': self.opened,
+            }
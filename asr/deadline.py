@@ -0,0 +1,87 @@
+import time
+import asyncio
+from contextlib import contextmanager, asynccontextmanager
+
+import gevent
+
+
+class DeadlineExceeded(Exception):
+    """A request ran out of time; ``stage`` is what it was doing."""
+
+    def __init__(self, stage):
+        super().__init__(f"request deadline exceeded during {stage}")
+        self.stage = stage
+
+
+def request_deadline(start, seconds, header_value=None):
+    """
+    Work out when a request has to be answered by.
+
+    Args:
+        start: When the request arrived, as time.time()
+        seconds: The configured time budget (0 = none)
+        header_value: Seconds the client says it will wait, if it sent them; can only shorten the budget
+
+    Returns:
+        The deadline as time.time(), or None if there is none.
+    """
+    if header_value:
+        try:
+            client_seconds = float(header_value)
+        except ValueError:
+            client_seconds = 0
+        if client_seconds > 0:
+            seconds = min(seconds, client_seconds) if seconds else client_seconds
+    if not seconds:
+        return None
+    return start + seconds
+
+
+def remaining(deadline):
+    """Seconds left until deadline (never negative), or None if there is no deadline."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.time())
+
+
+@contextmanager
+def enforce(deadline, stage):
+    """
+    Run the block within the deadline. When time runs out whatever it is
+    waiting on is interrupted and DeadlineExceeded(stage) is raised.
+    """
+    if deadline is None:
+        yield
+        return
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded(stage)
+    timeout = gevent.Timeout(left)
+    timeout.start()
+    try:
+        yield
+    except gevent.Timeout as e:
+        if e is not timeout:
+            raise
+        raise DeadlineExceeded(stage) from None
+    finally:
+        timeout.close()
+
+
+@asynccontextmanager
+async def enforce_async(deadline, stage):
+    """Like ``enforce()``, on an asyncio loop: the block is cancelled when time runs out."""
+    if deadline is None:
+        yield
+        return
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceeded(stage)
+    timeout = asyncio.timeout(left)
+    try:
+        async with timeout:
+            yield
+    except TimeoutError:
+        if not timeout.expired():
+            raise
+        raise DeadlineExceeded(stage) from None
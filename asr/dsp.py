@@ -0,0 +1,244 @@
+import logging
+from functools import lru_cache
+
+import numpy as np
+
+logger = logging.getLogger('rebble-asr')
+
+FULL_SCALE = 32767.0
+
+
+def db_to_amplitude(db):
+    """Convert a level in dBFS to a 16-bit sample amplitude."""
+    return FULL_SCALE * 10 ** (db / 20.0)
+
+
+def rms(pcm):
+    """RMS level of a block of 16-bit PCM, as a sample amplitude."""
+    samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+    if not samples.size:
+        return 0.0
+    return float(np.sqrt(np.mean(samples * samples)))
+
+
+@lru_cache(maxsize=16)
+def _lowpass_taps(cutoff, rate, numtaps):
+    """Windowed-sinc low-pass FIR taps with unity gain at DC."""
+    n = np.arange(numtaps) - (numtaps - 1) / 2.0
+    taps = np.sinc(2.0 * cutoff / rate * n) * np.blackman(numtaps)
+    return taps / taps.sum()
+
+
+@lru_cache(maxsize=16)
+def _highpass_taps(cutoff, rate, numtaps):
+    # Spectral inversion of the matching low-pass
+    taps = -_lowpass_taps(cutoff, rate, numtaps)
+    taps[(numtaps - 1) // 2] += 1.0
+    return taps
+
+
+class StreamingFIR:
+    """
+    Applies an FIR filter to a signal that arrives in blocks.
+
+    The last samples of each block are carried into the next, and the
+    filter's group delay is removed: the output lines up with the input, as
+    long as ``flush()`` is called after the last block.
+    """
+
+    def __init__(self, taps):
+        self.taps = taps
+        self._tail = np.zeros(len(taps) - 1, dtype=np.float32)
+        self._skip = (len(taps) - 1) // 2
+
+    def process(self, samples):
+        buf = np.concatenate((self._tail, samples))
+        out = np.convolve(buf, self.taps, mode='valid').astype(np.float32)
+        self._tail = buf[len(buf) - len(self._tail):]
+        if self._skip:
+            skip = min(self._skip, len(out))
+            self._skip -= skip
+            out = out[skip:]
+        return out
+
+    def flush(self):
+        return self.process(np.zeros((len(self.taps) - 1) // 2, dtype=np.float32))
+
+
+class Resampler:
+    """
+    Streaming sample rate conversion by linear interpolation.
+
+    When downsampling the signal is low-pass filtered first so content above
+    the new Nyquist frequency doesn't fold back into the speech band.
+    """
+
+    def __init__(self, in_rate, out_rate, numtaps=63):
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.step = in_rate / out_rate
+        self._filter = None
+        if out_rate < in_rate:
+            self._filter = StreamingFIR(_lowpass_taps(0.45 * out_rate, in_rate, numtaps))
+        self._last = None
+        self._pos = 0.0
+
+    def _interpolate(self, samples):
+        if self._last is not None:
+            samples = np.concatenate(([self._last], samples))
+        if len(samples) < 2:
+            return np.zeros(0, dtype=np.float32)
+        # Output samples are interpolated between their two neighbours, so stop
+        # before the last input sample; its right neighbour is in the next block
+        count = int(np.ceil((len(samples) - 1 - self._pos) / self.step))
+        count = max(0, count)
+        positions = self._pos + self.step * np.arange(count)
+        out = np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+        self._pos += count * self.step - (len(samples) - 1)
+        self._last = samples[-1]
+        return out
+
+    def process(self, samples):
+        if self._filter is not None:
+            samples = self._filter.process(samples)
+        return self._interpolate(samples)
+
+    def flush(self):
+        if self._filter is None:
+            return np.zeros(0, dtype=np.float32)
+        return self._interpolate(self._filter.flush())
+
+
+class AudioProcessor:
+    """
+    Cleans up decoded speech before it is trimmed and transcribed.
+
+    Decoded frames are grouped into blocks of ``block_ms`` and each block is
+    processed with NumPy in one go:
+
+    - DC removal: a slowly tracking offset is subtracted (``dc_removal``).
+    - High-pass: an FIR filter removes rumble and handling noise below
+      ``highpass_hz`` (0 disables it).
+    - Gain: automatic gain brings the recent peak level up to ``target_db``,
+      by at most ``max_gain`` and never below unity. The gain follows the
+      loudest recent peak right away and recovers over ``release_seconds``,
+      ramped across each block to avoid steps.
+    - Limiter: peaks above ``target_db`` are softly compressed into the
+      remaining headroom instead of being clipped.
+    - Resampling: if ``output_rate`` differs from ``rate`` the audio is
+      converted on the way out.
+
+    One processor handles one request, since it carries state from block
+    to block.
+    """
+
+    def __init__(self, rate=16000, output_rate=None, max_gain=7.0, target_db=-3.0, release_seconds=1.0,
+                 highpass_hz=0.0, dc_removal=True, block_ms=100, highpass_taps=255):
+        self.rate = rate
+        self.output_rate = output_rate or rate
+        self.max_gain = max_gain
+        self.target = db_to_amplitude(target_db)
+        self.block_ms = block_ms
+        self.block_bytes = rate * 2 * block_ms // 1000
+        self.dc_removal = dc_removal
+        self._release = 10 ** (-block_ms / 1000.0 / max(release_seconds, 1e-3))
+        self._highpass = StreamingFIR(_highpass_taps(float(highpass_hz), rate, highpass_taps)) if highpass_hz else None
+        self._resampler = Resampler(rate, self.output_rate) if self.output_rate != rate else None
+        self._dc = None
+        self._envelope = 0.0
+        self._gain = None
+        self._ramps = {}
+
+    def _ramp(self, start, end, length):
+        # np.linspace is slow for short arrays, so scale a cached 0..1 ramp instead
+        ramp = self._ramps.get(length)
+        if ramp is None:
+            ramp = self._ramps[length] = np.linspace(0.0, 1.0, length, dtype=np.float32)
+        return np.float32(start) + np.float32(end - start) * ramp
+
+    def _remove_dc(self, samples):
+        mean = float(samples.sum()) / len(samples)
+        if self._dc is None:
+            self._dc = mean
+        dc = 0.8 * self._dc + 0.2 * mean
+        samples = samples - self._ramp(self._dc, dc, len(samples))
+        self._dc = dc
+        return samples
+
+    def _apply_gain(self, samples):
+        peak = max(float(samples.max()), -float(samples.min())) if samples.size else 0.0
+        self._envelope = max(peak, self._envelope * self._release)
+        gain = self.target / self._envelope if self._envelope > 0 else self.max_gain
+        gain = min(self.max_gain, max(1.0, gain))
+        if self._gain is None or gain <= self._gain:
+            # Turn down at once so a loud block doesn't overshoot
+            samples = samples * np.float32(gain)
+        else:
+            samples = samples * self._ramp(self._gain, gain, len(samples))
+        self._gain = gain
+        return samples
+
+    def _limit(self, samples):
+        knee = self.target
+        headroom = FULL_SCALE - knee
+        magnitude = np.abs(samples)
+        over = magnitude > knee
+        if over.any():
+            limited = knee + headroom * np.tanh((magnitude[over] - knee) / headroom)
+            samples[over] = np.copysign(limited, samples[over])
+        return samples
+
+    def _process(self, samples):
+        if self.dc_removal and samples.size:
+            samples = self._remove_dc(samples)
+        if self._highpass is not None:
+            samples = self._highpass.process(samples)
+        if samples.size:
+            samples = self._limit(self._apply_gain(samples))
+        if self._resampler is not None:
+            samples = self._resampler.process(samples)
+        return samples
+
+    def _flush(self):
+        samples = np.zeros(0, dtype=np.float32)
+        if self._highpass is not None:
+            samples = self._highpass.flush()
+            if samples.size:
+                samples = self._limit(self._apply_gain(samples))
+        if self._resampler is not None:
+            samples = np.concatenate((self._resampler.process(samples), self._resampler.flush()))
+        return samples
+
+    @staticmethod
+    def _to_pcm(samples):
+        np.rint(samples, out=samples)
+        np.clip(samples, -32768, 32767, out=samples)
+        return samples.astype('<i2').tobytes()
+
+    def process(self, frames):
+        """
+        Process decoded 16-bit PCM frames as they arrive.
+
+        Yields:
+            Processed 16-bit PCM in blocks of about ``block_ms``.
+        """
+        pending = bytearray()
+        for frame in frames:
+            pending += frame
+            if len(pending) < self.block_bytes:
+                continue
+            samples = np.frombuffer(pending, dtype='<i2').astype(np.float32)
+            pending = bytearray()
+            out = self._process(samples)
+            if out.size:
+                yield self._to_pcm(out)
+
+        if pending:
+            # Keep whole samples only
+            pending = pending[:len(pending) - len(pending) % 2]
+            out = self._process(np.frombuffer(pending, dtype='<i2').astype(np.float32))
+            out = np.concatenate((out, self._flush()))
+        else:
+            out = self._flush()
+        if out.size:
+            yield self._to_pcm(out)
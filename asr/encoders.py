@@ -0,0 +1,72 @@
+import io
+import logging
+
+logger = logging.getLogger('rebble-asr')
+
+try:
+    import soundfile
+    HAS_SOUNDFILE = True
+except (ImportError, OSError):
+    # OSError: the package is installed but libsndfile can't be loaded
+    HAS_SOUNDFILE = False
+
+
+class AudioEncoder:
+    """
+    Turns the request's audio into the upload format of a provider.
+
+    ``encode(audio)`` takes a PcmBuffer and returns a ``(filename, file,
+    mimetype)`` tuple that can be passed to ``requests`` as an upload. If
+    encoding fails the audio is uploaded as WAV.
+    """
+
+    def __init__(self, name, filename, mimetype, encode):
+        self.name = name
+        self.filename = filename
+        self.mimetype = mimetype
+        self._encode = encode
+
+    def encode(self, audio):
+        try:
+            return self.filename, self._encode(audio), self.mimetype
+        except Exception as e:
+            logger.error(f"Failed to encode audio as {self.name}, uploading WAV instead: {e}")
+            return 'audio.wav', audio.wav(), 'audio/wav'
+
+
+def _encode_wav(audio):
+    return audio.wav()
+
+
+def _soundfile_encoder(format, subtype):
+    def encode(audio):
+        out = io.BytesIO()
+        with soundfile.SoundFile(out, 'w', samplerate=audio.rate, channels=audio.channels,
+                                 format=format, subtype=subtype) as f:
+            f.buffer_write(audio.pcm, dtype='int16')
+        out.seek(0)
+        return out
+    return encode
+
+
+ENCODERS = {
+    'wav': AudioEncoder('wav', 'audio.wav', 'audio/wav', _encode_wav),
+    # Lossless, typically around half the size of WAV for speech
+    'flac': AudioEncoder('flac', 'audio.flac', 'audio/flac', _soundfile_encoder('FLAC', 'PCM_16')),
+    # Lossy, an order of magnitude smaller than WAV
+    'opus': AudioEncoder('opus', 'audio.ogg', 'audio/ogg', _soundfile_encoder('OGG', 'OPUS')),
+}
+
+
+def get_encoder(name):
+    """
+    Look up an encoder by name, falling back to WAV if it is unknown or can't be used.
+    """
+    name = (name or 'wav').strip().lower()
+    if name not in ENCODERS:
+        logger.warning(f"Unknown audio format '{name}', uploading WAV instead")
+        return ENCODERS['wav']
+    if name != 'wav' and not HAS_SOUNDFILE:
+        logger.warning(f"Audio format '{name}' needs the soundfile package, uploading WAV instead")
+        return ENCODERS['wav']
+    return ENCODERS[name]
@@ -0,0 +1,191 @@
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+
+import gevent
+
+logger = logging.getLogger('rebble-asr')
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies (in seconds) for percentile estimates."""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, latency):
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, p):
+        """
+        Return the p-th percentile (0-100) of the window using nearest rank.
+
+        Returns:
+            The latency in seconds, or None if nothing has been recorded yet.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        rank = max(0, min(len(samples) - 1, int(round(p / 100.0 * len(samples))) - 1))
+        return samples[rank]
+
+
+def _result(task):
+    """The result of a finished task, or None if it failed or was cancelled."""
+    if task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+
+class Hedger:
+    """
+    Races a secondary provider against a slow primary to cut tail latency.
+
+    The primary is started on its own greenlet. If it hasn't answered within
+    the hedge delay, the secondary is started as well and whichever returns a
+    transcript first wins; the other greenlet is killed. A provider that fails
+    (returns None or raises) doesn't end the race while the other is still
+    running, and a primary that fails before the hedge delay has the
+    secondary started straight away.
+
+    The hedge delay is the ``percentile`` of recent primary latencies, so only
+    the slowest requests are hedged. Until ``min_samples`` latencies have been
+    seen, ``initial_delay`` is used instead, and the delay never drops below
+    ``min_delay``.
+    """
+
+    def __init__(self, percentile=95, initial_delay=3.0, min_delay=0.5, window=200, min_samples=20):
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+
+    def delay(self):
+        """How long to wait for the primary before firing the secondary, in seconds."""
+        if len(self.latencies) < self.min_samples:
+            return max(self.min_delay, self.initial_delay)
+        return max(self.min_delay, self.latencies.percentile(self.percentile))
+
+    def run(self, primary, secondary):
+        """
+        Call primary(), hedging with secondary() if it is slow or fails.
+
+        Returns:
+            The first transcript returned, or None if both failed.
+        """
+        with self._lock:
+            self.requests += 1
+
+        start = time.time()
+        delay = self.delay()
+        first = gevent.spawn(primary)
+        greenlets = [first]
+        try:
+            first.join(timeout=delay)
+            if first.ready():
+                result = first.value if first.successful() else None
+                if result is not None:
+                    self.latencies.record(time.time() - start)
+                    return result
+                logger.info("Primary provider failed, trying the secondary")
+                pending = []
+            else:
+                logger.info(f"Primary provider hasn't answered after {delay:.2f}s, hedging with the secondary")
+                pending = [first]
+
+            with self._lock:
+                self.hedges_fired += 1
+            second = gevent.spawn(secondary)
+            greenlets.append(second)
+            pending.append(second)
+
+            winner = None
+            while pending and winner is None:
+                for done in gevent.wait(pending, count=1):
+                    pending.remove(done)
+                    if done.successful() and done.value is not None:
+                        winner = done
+                        break
+        except BaseException:
+            # The caller was interrupted (e.g. by its deadline): stop both before it cleans up
+            gevent.killall(greenlets)
+            raise
+
+        # Cancel the loser; its provider cleans up when the greenlet is killed
+        gevent.killall(pending, block=False)
+
+        if winner is None:
+            return None
+        if winner is first:
+            self.latencies.record(time.time() - start)
+        else:
+            with self._lock:
+                self.hedges_won += 1
+            logger.info(f"Hedged request won after {time.time() - start:.2f}s")
+        return winner.value
+
+    async def run_async(self, primary, secondary):
+        """Like ``run()``, for coroutine functions on an asyncio loop."""
+        with self._lock:
+            self.requests += 1
+
+        start = time.time()
+        delay = self.delay()
+        tasks = [asyncio.ensure_future(primary())]
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                result = _result(tasks[0])
+                if result is not None:
+                    self.latencies.record(time.time() - start)
+                    return result
+                logger.info("Primary provider failed, trying the secondary")
+            else:
+                logger.info(f"Primary provider hasn't answered after {delay:.2f}s, hedging with the secondary")
+
+            with self._lock:
+                self.hedges_fired += 1
+            tasks.append(asyncio.ensure_future(secondary()))
+            pending.add(tasks[-1])
+
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if _result(task) is not None), None)
+        finally:
+            # Cancel the loser (or both, if the request itself was cancelled);
+            # its provider cleans up when the task is cancelled
+            for task in tasks:
+                task.cancel()
+
+        if winner is None:
+            return None
+        if winner is tasks[0]:
+            self.latencies.record(time.time() - start)
+        else:
+            with self._lock:
+                self.hedges_won += 1
+            logger.info(f"Hedged request won after {time.time() - start:.2f}s")
+        return winner.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'hedges_fired': self.hedges_fired,
+                'hedges_won': self.hedges_won,
+                'delay': self.delay(),
+            }
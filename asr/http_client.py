@@ -0,0 +1,57 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('rebble-asr')
+
+
+class HttpClient:
+    """
+    Keep-alive HTTP client shared by every request in a worker.
+
+    Connections to the cloud providers are pooled per host, so a dictation
+    reuses an open TLS connection instead of repeating DNS, TCP and TLS
+    handshakes. Every call has a connect and a read timeout; the request
+    deadline is left to the caller (see ``deadline.enforce()``).
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=3.0, read_timeout=30.0):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapter = adapter
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+
+    def post(self, url, **kwargs):
+        """POST through the shared session. Raises requests exceptions like requests.post."""
+        with self._lock:
+            self.requests += 1
+        try:
+            return self.session.post(url, timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self.failures += 1
+            raise
+
+    def stats(self):
+        # urllib3 counts the connections each host pool had to open
+        pools = self._adapter.poolmanager.pools
+        opened = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'connections_opened': opened,
+                'connections_reused': max(0, self.requests - opened),
+            }
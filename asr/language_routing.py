@@ -0,0 +1,146 @@
+import re
+import json
+import logging
+
+from .model_map import MODEL_MAP
+
+logger = logging.getLogger('rebble-asr')
+
+PROVIDERS = ('elevenlabs', 'groq', 'wyoming-whisper', 'vosk')
+
+# The providers take ISO 639-1 language codes; a few locales use another code for the language
+HINT_ALIASES = {'nb': 'no'}
+# Languages without a code the providers agree on are left to language detection
+NO_HINT = {'fil', 'zu'}
+
+
+def normalize_locale(value):
+    """
+    Normalise a locale such as 'en-US' or 'en_us' to 'en-us'.
+
+    Returns:
+        The lowercase locale, or None if value isn't one.
+    """
+    if not isinstance(value, str):
+        return None
+    locale = value.strip().lower().replace('_', '-')
+    if not re.fullmatch(r'[a-z]{2,3}-[a-z]{2}', locale):
+        return None
+    return locale
+
+
+def language_from_header_parts(parts):
+    """
+    Find the dictation locale in the bodies of the Nuance header parts of a
+    request; the RequestData part carries it as JSON, in
+    ``cmdDict.dictation_language``.
+
+    Returns:
+        A lowercase locale such as 'en-us', or None if the parts don't carry one.
+    """
+    for body in parts:
+        try:
+            data = json.loads(body)
+        except (ValueError, UnicodeDecodeError):
+            continue
+        command = data.get('cmdDict') if isinstance(data, dict) else None
+        if isinstance(command, dict):
+            locale = normalize_locale(command.get('dictation_language'))
+            if locale is not None:
+                return locale
+    return None
+
+
+class Route:
+    """
+    Where dictations in a language go: a provider and, optionally, the model
+    to ask it for and (for Wyoming) the backends to use instead of the
+    default ones, as a comma-separated ``host[:port]`` list.
+    """
+
+    def __init__(self, provider, model=None, hosts=None):
+        self.provider = provider
+        self.model = model
+        self.hosts = hosts
+
+    def __repr__(self):
+        return (self.provider + (f"/{self.model}" if self.model else '')
+                + (f"@{self.hosts.replace(',', ';')}" if self.hosts else ''))
+
+
+def parse_routes(value):
+    """
+    Parse a comma-separated list of ``<language>=<provider>[/<model>][@<host:port>;...]``
+    routes, e.g. ``de=wyoming-whisper@whisper-de:10300,en=groq/whisper-large-v3-turbo``.
+
+    ``<language>`` is a locale ('fr-ca') or just a language ('fr'), which
+    covers each of its locales without a route of their own. The model is
+    asked of Groq and ElevenLabs, and of a Wyoming server as the model name in
+    its ``Transcribe`` event. Malformed entries are skipped with a warning.
+
+    Returns:
+        A dict of language to Route.
+    """
+    routes = {}
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        language, sep, target = entry.partition('=')
+        language = language.strip().lower().replace('_', '-')
+        target, _, hosts = target.strip().partition('@')
+        provider, _, model = target.partition('/')
+        if not sep or not re.fullmatch(r'[a-z]{2,3}(-[a-z]{2})?', language) or provider not in PROVIDERS:
+            logger.warning(f"Ignoring invalid language route: {entry!r}")
+            continue
+        if hosts and provider != 'wyoming-whisper':
+            logger.warning(f"Ignoring backends in language route {entry!r}, only Wyoming takes them")
+            hosts = ''
+        if model and provider == 'vosk':
+            logger.warning(f"Ignoring model in language route {entry!r}, Vosk picks its model by language")
+            model = ''
+        routes[language] = Route(provider, model or None, hosts.replace(';', ',') or None)
+    return routes
+
+
+class LanguageRouter:
+    """
+    Picks the provider for a dictation from its language, and the language
+    hint passed to the provider.
+
+    A locale ('de-at') uses its own route if it has one, then the route of
+    its language ('de'), then ``default_provider``.
+
+    Locales Rebble offers for dictation (those in ``MODEL_MAP``) are passed
+    to the providers as a language hint, so they can skip detecting the
+    language: it saves time and avoids transcribing a short dictation in the
+    wrong language. Other locales, or all of them without ``hints``, are
+    left to detection.
+    """
+
+    def __init__(self, routes, default_provider, hints=True):
+        self.routes = routes
+        self.default = Route(default_provider)
+        self.hints = hints
+
+    def route(self, locale):
+        if locale:
+            for language in (locale, locale.split('-', 1)[0]):
+                route = self.routes.get(language)
+                if route is not None:
+                    return route
+        return self.default
+
+    def hint(self, locale):
+        """The ISO 639-1 language code to pass to the providers, or None to let them detect it."""
+        if not self.hints or locale not in MODEL_MAP:
+            return None
+        language = locale.split('-', 1)[0]
+        if language in NO_HINT:
+            return None
+        return HINT_ALIASES.get(language, language)
+
+    def model(self, provider, locale):
+        """The model the locale's route asks provider for, or None for the provider's default."""
+        route = self.route(locale)
+        return route.model if route.provider == provider else None
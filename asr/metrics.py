@@ -0,0 +1,184 @@
+import os
+import glob
+import time
+import asyncio
+
+from gevent import GreenletExit, Timeout
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+from prometheus_client import multiprocess
+
+# Under gunicorn every worker is its own process. With PROMETHEUS_MULTIPROC_DIR set,
+# each worker writes its samples to files there and /metrics adds them all up.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+MULTIPROCESS = bool(MULTIPROC_DIR)
+if MULTIPROCESS:
+    # gunicorn.conf.py creates it before the workers start, other servers (uvicorn for asr.asgi) don't
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 20.0, 30.0)
+
+REQUESTS = Counter('asr_requests_total', 'Dictation requests by outcome', ['outcome'])
+REQUEST_DURATION = Histogram('asr_request_duration_seconds', 'Time from the start of a request to its response',
+                             buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge('asr_requests_in_flight', 'Dictation requests being handled', multiprocess_mode='livesum')
+STAGE_DURATION = Histogram('asr_stage_duration_seconds', 'Time spent in each stage of the audio pipeline per request',
+                           ['stage'], buckets=STAGE_BUCKETS)
+PROVIDER_DURATION = Histogram('asr_provider_duration_seconds', 'Time spent waiting for a transcription provider',
+                              ['provider', 'outcome'], buckets=LATENCY_BUCKETS)
+FALLBACKS = Counter('asr_fallbacks_total', 'Requests that fell back to Vosk, by the provider that failed', ['provider'])
+AUDIO_SECONDS = Counter('asr_audio_seconds_total', 'Seconds of decoded audio processed')
+ADMISSION_WAIT = Histogram('asr_admission_wait_seconds', 'Time queued requests waited for a provider slot',
+                           ['provider'], buckets=STAGE_BUCKETS)
+ADMISSION_QUEUE = Gauge('asr_admission_queue_depth', 'Requests waiting for a provider slot', ['provider'],
+                        multiprocess_mode='livesum')
+ADMISSION_REJECTED = Counter('asr_admission_rejected_total', 'Requests a provider turned away, by reason (shed, timeout)',
+                             ['provider', 'reason'])
+DEADLINE_EXCEEDED = Counter('asr_deadline_exceeded_total', 'Requests that ran out of time, by the stage they were in',
+                            ['stage'])
+
+
+class StageTimer:
+    """
+    Measures how long each stage of a streaming pipeline takes.
+
+    The audio pipeline is a chain of generators, so the stages run interleaved
+    as the upload arrives. ``wrap()`` counts the time spent fetching items
+    from a stage, which includes the stages before it; ``durations()``
+    subtracts those to give the time of each stage alone.
+    """
+
+    def __init__(self):
+        self._order = []
+        self._totals = {}
+
+    def wrap(self, stage, iterable):
+        self._order.append(stage)
+        self._totals[stage] = 0.0
+        return self._timed(stage, iterable)
+
+    def _timed(self, stage, iterable):
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self._totals[stage] += time.perf_counter() - start
+                return
+            self._totals[stage] += time.perf_counter() - start
+            yield item
+
+    def durations(self):
+        """Time spent in each stage alone, in the order the stages were wrapped."""
+        result = {}
+        previous = 0.0
+        for stage in self._order:
+            total = self._totals[stage]
+            result[stage] = max(0.0, total - previous)
+            previous = total
+        return result
+
+    def observe(self):
+        for stage, seconds in self.durations().items():
+            STAGE_DURATION.labels(stage).observe(seconds)
+
+
+def observe_provider(provider, fn, *args, **kwargs):
+    """
+    Call a provider and record how long it took and how it went.
+
+    The outcome is 'ok', 'failed' (it returned None) or 'cancelled' (e.g. it
+    lost a hedged race or ran out of time).
+    """
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    except (GreenletExit, Timeout):
+        PROVIDER_DURATION.labels(provider, 'cancelled').observe(time.perf_counter() - start)
+        raise
+    except Exception:
+        PROVIDER_DURATION.labels(provider, 'failed').observe(time.perf_counter() - start)
+        raise
+    PROVIDER_DURATION.labels(provider, 'ok' if result is not None else 'failed').observe(time.perf_counter() - start)
+    return result
+
+
+async def observe_provider_async(provider, fn, *args, **kwargs):
+    """Like ``observe_provider()``, for a coroutine function."""
+    start = time.perf_counter()
+    try:
+        result = await fn(*args, **kwargs)
+    except asyncio.CancelledError:
+        PROVIDER_DURATION.labels(provider, 'cancelled').observe(time.perf_counter() - start)
+        raise
+    except Exception:
+        PROVIDER_DURATION.labels(provider, 'failed').observe(time.perf_counter() - start)
+        raise
+    PROVIDER_DURATION.labels(provider, 'ok' if result is not None else 'failed').observe(time.perf_counter() - start)
+    return result
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clean_multiprocess_dir():
+    """
+    Tidy PROMETHEUS_MULTIPROC_DIR as a worker starts, for servers without
+    gunicorn's hooks (see gunicorn.conf.py), such as uvicorn for ``asr.asgi``.
+
+    If no other worker is running this is a fresh start, and the files left
+    by earlier runs are removed so their samples aren't added to the new ones.
+    Otherwise a worker is being replaced, and the workers that have died are
+    marked dead so their in-flight requests stop counting.
+    """
+    if not MULTIPROCESS:
+        return
+    files = {}
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, '*.db')):
+        pid = os.path.basename(path)[:-len('.db')].rpartition('_')[2]
+        if pid.isdigit():
+            files.setdefault(int(pid), []).append(path)
+
+    own = os.getpid()
+    dead = [pid for pid in files if pid != own and not _alive(pid)]
+    fresh = len(dead) == len(files) - (own in files)
+    for pid in dead:
+        if not fresh:
+            multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+            continue
+        for path in files[pid]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def mark_dead():
+    """Stop counting this worker's in-flight requests once it shuts down."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid(), MULTIPROC_DIR)
+
+
+def render():
+    """
+    Render every metric in the Prometheus text format.
+
+    Returns:
+        A (body, content type) tuple.
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
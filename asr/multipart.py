@@ -0,0 +1,140 @@
+import logging
+from email.message import Message
+
+logger = logging.getLogger('rebble-asr')
+
+
+def parse_boundary(content_type):
+    """
+    Extract the multipart boundary from a Content-Type header value.
+
+    Handles quoted boundaries and extra parameters in any order.
+
+    Returns:
+        The boundary as bytes, or None if the header doesn't carry one.
+    """
+    if not content_type:
+        return None
+    msg = Message()
+    msg['Content-Type'] = content_type
+    boundary = msg.get_param('boundary')
+    if not boundary or not isinstance(boundary, str):
+        return None
+    return boundary.strip().encode('latin-1')
+
+
+def _parse_headers(block):
+    headers = {}
+    for line in block.strip(b'\r\n').split(b'\r\n'):
+        name, sep, value = line.partition(b':')
+        if sep:
+            headers[name.strip().decode('latin-1').lower()] = value.strip().decode('latin-1')
+    return headers
+
+
+class Part:
+    """A single part of a multipart body. Headers are only parsed when accessed."""
+
+    __slots__ = ('raw_headers', 'body', '_headers')
+
+    def __init__(self, raw_headers, body):
+        self.raw_headers = raw_headers
+        self.body = body
+        self._headers = None
+
+    @property
+    def headers(self):
+        """The part headers as a dict with lowercased names."""
+        if self._headers is None:
+            self._headers = _parse_headers(self.raw_headers)
+        return self._headers
+
+
+class MultipartParser:
+    """
+    Incremental parser for multipart bodies.
+
+    Data is fed in as it arrives and complete parts are returned as soon as the
+    delimiter that ends them has been seen. The buffer only ever holds the part
+    currently being received, and every search resumes where the previous one
+    left off, so parsing is linear in the size of the body no matter how small
+    the reads are.
+    """
+
+    def __init__(self, boundary):
+        if isinstance(boundary, str):
+            boundary = boundary.encode('latin-1')
+        self._delimiter = b'--' + boundary
+        self._buffer = bytearray()
+        self._scan_from = 0
+        self._in_preamble = True
+        self.finished = False
+
+    def feed(self, data):
+        """
+        Add received bytes to the parser.
+
+        Returns:
+            A list of the Parts completed by this data (often empty).
+        """
+        if self.finished or not data:
+            return []
+
+        buf = self._buffer
+        buf += data
+        delimiter = self._delimiter
+        parts = []
+        start = 0
+
+        while True:
+            end = buf.find(delimiter, max(start, self._scan_from))
+            if end < 0:
+                break
+
+            if self._in_preamble:
+                # Anything before the first delimiter is preamble and is ignored
+                self._in_preamble = False
+            elif buf.startswith(b'--', start):
+                # The previous delimiter was the closing one
+                self.finished = True
+                break
+            else:
+                part = self._parse_part(buf, start, end)
+                if part is not None:
+                    parts.append(part)
+
+            start = end + len(delimiter)
+
+        if not self.finished and buf.startswith(b'--', start) and not self._in_preamble:
+            self.finished = True
+
+        if self.finished:
+            buf.clear()
+            self._scan_from = 0
+        else:
+            del buf[:start]
+            # The delimiter may straddle this read and the next one
+            self._scan_from = max(0, len(buf) - len(delimiter) + 1)
+        return parts
+
+    def _parse_part(self, buf, start, end):
+        header_end = buf.find(b'\r\n\r\n', start, end)
+        if header_end < 0:
+            return None
+
+        body_start = header_end + 4
+        # The CRLF in front of the delimiter belongs to the delimiter, not the body
+        body_end = end - 2 if buf.startswith(b'\r\n', end - 2) and end - 2 >= body_start else end
+
+        return Part(bytes(buf[start:header_end]), bytes(buf[body_start:body_end]))
+
+
+def iter_parts(stream, boundary, read_size=4096):
+    """Yield the Parts of a multipart body read from a file-like stream as they arrive."""
+    parser = MultipartParser(boundary)
+    while not parser.finished:
+        data = stream.read(read_size)
+        if not data:
+            logger.debug("End of input.")
+            break
+        yield from parser.feed(data)
@@ -0,0 +1,224 @@
+import os
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+import concurrent.futures
+from datetime import datetime
+
+import gevent
+import gevent.queue
+from gevent.threadpool import ThreadPool
+
+logger = logging.getLogger('rebble-asr')
+
+MANIFEST_NAME = '.recordings.sqlite3'
+
+
+class RecordingStore:
+    """
+    Saves recordings and their transcripts to disk without holding up the response.
+
+    ``save()`` only queues the recording. A background greenlet (or, when
+    serving on asyncio, a task) writes the files on a separate OS thread, so
+    the disk I/O never blocks the event loop, and at most ``queue_size``
+    recordings wait to be written; when the queue is full new recordings are
+    dropped.
+
+    Saved recordings are listed in a small SQLite manifest in the directory,
+    shared by every worker, so rotating out the oldest recordings once there
+    are more than ``max_files`` (or more than ``max_bytes`` on disk, if set)
+    is an indexed query instead of a scan of the directory. The manifest is
+    built from the files already there the first time the directory is used.
+    """
+
+    def __init__(self, directory, max_files=10, max_bytes=0, queue_size=64):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.queue_size = queue_size
+        self._queue = None
+        self._pool = None
+        self._task = None
+        self._db = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.saved = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotated = 0
+
+    def _connect(self):
+        db = sqlite3.connect(os.path.join(self.directory, MANIFEST_NAME), timeout=10, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS recordings (id TEXT PRIMARY KEY, created REAL NOT NULL, size INTEGER NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS recordings_created ON recordings (created)')
+        with db:
+            if db.execute('SELECT COUNT(*) FROM recordings').fetchone()[0] == 0:
+                # First use of this directory: index the recordings that are already there
+                rows = []
+                for filename in os.listdir(self.directory):
+                    if not filename.endswith('.wav'):
+                        continue
+                    recording_id = filename[:-len('.wav')]
+                    rows.append((recording_id, os.path.getmtime(os.path.join(self.directory, filename)), self._size(recording_id)))
+                db.executemany('INSERT OR IGNORE INTO recordings VALUES (?, ?, ?)', rows)
+                if rows:
+                    logger.info(f"Indexed {len(rows)} existing recordings in {self.directory}")
+        return db
+
+    def _size(self, recording_id):
+        size = 0
+        for ext in ('.wav', '.txt'):
+            try:
+                size += os.path.getsize(os.path.join(self.directory, recording_id + ext))
+            except OSError:
+                pass
+        return size
+
+    def start(self, loop=None):
+        """
+        Start the background writer: a greenlet, or a task on ``loop`` when
+        serving on asyncio. Recordings can only be saved once it has started.
+
+        Raises:
+            sqlite3.Error, OSError: if the manifest can't be opened in the directory.
+        """
+        if self._pool is not None:
+            return self
+        if loop is None:
+            pool = ThreadPool(1)
+            try:
+                self._db = pool.apply(self._connect)
+            except BaseException:
+                pool.kill()
+                raise
+            self._pool = pool
+            self._queue = gevent.queue.Queue(maxsize=self.queue_size)
+            gevent.spawn(self._run)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='recordings')
+            try:
+                self._db = pool.submit(self._connect).result()
+            except BaseException:
+                pool.shutdown(wait=False)
+                raise
+            self._pool = pool
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = loop.create_task(self._run_async())
+        return self
+
+    def save(self, audio, transcript):
+        """
+        Queue a recording to be written.
+
+        Args:
+            audio: PcmBuffer holding the decoded audio
+            transcript: The transcribed text string
+
+        Returns:
+            The recording's ID, or None if it was dropped.
+        """
+        recording_id = f"recording_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        try:
+            self._queue.put_nowait((recording_id, audio, transcript))
+        except (gevent.queue.Full, asyncio.QueueFull):
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"Recording queue full ({self._queue.qsize()} waiting), dropping {recording_id}")
+            return None
+        with self._lock:
+            self.queued += 1
+        return recording_id
+
+    def _run(self):
+        while True:
+            recording_id, audio, transcript = self._queue.get()
+            try:
+                self._pool.apply(self._write, (recording_id, audio, transcript))
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Failed to save recording {recording_id}: {e}")
+
+    async def _run_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            recording_id, audio, transcript = await self._queue.get()
+            try:
+                await loop.run_in_executor(self._pool, self._write, recording_id, audio, transcript)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Failed to save recording {recording_id}: {e}")
+
+    def _write(self, recording_id, audio, transcript):
+        wav_path = os.path.join(self.directory, f"{recording_id}.wav")
+        txt_path = os.path.join(self.directory, f"{recording_id}.txt")
+
+        with open(wav_path, 'wb') as f:
+            f.write(audio.wav_header())
+            f.write(audio.pcm)
+        with open(txt_path, 'w', encoding='utf-8') as f:
+            f.write(transcript)
+        size = os.path.getsize(wav_path) + os.path.getsize(txt_path)
+
+        try:
+            with self._db:
+                self._db.execute('INSERT INTO recordings VALUES (?, ?, ?)', (recording_id, time.time(), size))
+        except sqlite3.Error:
+            # Rotation would never find files missing from the manifest
+            for path in (wav_path, txt_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            raise
+        with self._lock:
+            self.saved += 1
+        logger.debug(f"Saved recording: {wav_path} ({size} bytes)")
+
+        self._rotate()
+
+    def _rotate(self):
+        try:
+            with self._db:
+                count, total = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM recordings').fetchone()
+                expired = []
+                for recording_id, size in self._db.execute('SELECT id, size FROM recordings ORDER BY created'):
+                    if count <= self.max_files and (not self.max_bytes or total <= self.max_bytes):
+                        break
+                    expired.append(recording_id)
+                    count -= 1
+                    total -= size
+                self._db.executemany('DELETE FROM recordings WHERE id = ?', [(recording_id,) for recording_id in expired])
+        except sqlite3.Error as e:
+            # The recording is saved; the next one tries again
+            logger.error(f"Failed to rotate old recordings: {e}")
+            return
+
+        for recording_id in expired:
+            for ext in ('.wav', '.txt'):
+                try:
+                    os.remove(os.path.join(self.directory, recording_id + ext))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.error(f"Failed to delete old recording file '{recording_id}{ext}': {e}")
+            logger.debug(f"Deleted old recording: {recording_id}")
+        if expired:
+            with self._lock:
+                self.rotated += len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+                'queued': self.queued,
+                'saved': self.saved,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'rotated': self.rotated,
+            }
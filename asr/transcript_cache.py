@@ -0,0 +1,160 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('rebble-asr')
+
+try:
+    import redis
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+
+def cache_key(pcm, provider, language):
+    """Key for a transcript: a hash of the decoded PCM, the provider and the language."""
+    digest = hashlib.blake2b(pcm, digest_size=16).hexdigest()
+    return f"{provider}:{language or 'default'}:{digest}"
+
+
+class RedisCacheBackend:
+    """
+    Shares cached transcripts between workers (and instances) through Redis.
+
+    Anything that speaks the Redis protocol works, e.g. a local Redis or
+    Valkey container. Keys are written with an expiry, so Redis enforces the
+    TTL itself.
+    """
+
+    def __init__(self, url, prefix='rebble-asr:transcript:', timeout=0.2):
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value.encode('utf-8'), ex=max(1, int(ttl)))
+
+
+class TranscriptCache:
+    """
+    Remembers recent transcripts so a repeated upload isn't transcribed again.
+
+    Watches retry a dictation when the response is lost, sending the same
+    audio again. Entries live in an in-process LRU holding at most
+    ``max_entries`` transcripts and ``max_bytes`` of transcript text, and
+    expire after ``ttl`` seconds.
+
+    With a shared ``backend`` (see RedisCacheBackend), a local miss is looked
+    up there too, so a retry that lands on another worker still hits. The
+    backend is best effort: if it fails, the request carries on as a miss.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=1024 * 1024, ttl=300.0, backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.backend_errors = 0
+
+    @staticmethod
+    def _size(key, transcript):
+        return len(key) + len(transcript.encode('utf-8'))
+
+    def _remove(self, key):
+        transcript, _ = self._entries.pop(key)
+        self._bytes -= self._size(key, transcript)
+
+    def _store(self, key, transcript, expires):
+        size = self._size(key, transcript)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (transcript, expires)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get(self, key):
+        """
+        Look up a transcript.
+
+        Returns:
+            The cached transcript, or None on a miss.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                transcript, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return transcript
+                self._remove(key)
+                self.expirations += 1
+
+        if self.backend is not None:
+            try:
+                transcript = self.backend.get(key)
+            except Exception as e:
+                transcript = None
+                with self._lock:
+                    self.backend_errors += 1
+                logger.warning(f"Transcript cache backend lookup failed: {e}")
+            if transcript is not None:
+                # The backend doesn't say how long the entry has left, so keep it for a full TTL here
+                self._store(key, transcript, now + self.ttl)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                return transcript
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, transcript):
+        """Remember a transcript, locally and in the shared backend if there is one."""
+        self._store(key, transcript, time.time() + self.ttl)
+        with self._lock:
+            self.stores += 1
+        if self.backend is not None:
+            try:
+                self.backend.set(key, transcript, self.ttl)
+            except Exception as e:
+                with self._lock:
+                    self.backend_errors += 1
+                logger.warning(f"Transcript cache backend store failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'backend_errors': self.backend_errors,
+            }
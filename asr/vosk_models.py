@@ -0,0 +1,263 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger('rebble-asr')
+
+# Files (or directories) every Vosk model directory must contain
+REQUIRED_MODEL_FILES = ['am', 'conf', 'ivector']
+
+
+def _resident_bytes():
+    """Return the resident set size of this process in bytes, or 0 if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _dir_size_bytes(path):
+    """Total size of the files under path, used when resident size can't be measured."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def validate_model_dir(model_path):
+    """
+    Check that a Vosk model directory exists and contains the required files.
+
+    Returns:
+        True if the directory looks usable, False otherwise (the reason is logged).
+    """
+    if not os.path.isdir(model_path):
+        logger.error(f"Vosk model directory not found at {model_path}")
+        return False
+
+    model_files = os.listdir(model_path)
+    logger.debug(f"Files in model directory: {model_files}")
+
+    missing_files = [f for f in REQUIRED_MODEL_FILES if not any(f in file for file in model_files)]
+    if missing_files:
+        logger.error(f"Missing required Vosk model files: {missing_files}")
+        return False
+    return True
+
+
+class LoadedModel:
+    """
+    A Vosk model loaded in memory together with a bounded pool of recognizers.
+
+    KaldiRecognizer instances are reset and recycled instead of being created
+    for every request. At most ``pool_size`` recognizers exist at once; callers
+    beyond that wait for one to be returned.
+    """
+
+    def __init__(self, path, model, sample_rate, pool_size, size_bytes=0, load_time=0.0):
+        self.path = path
+        self.model = model
+        self.sample_rate = sample_rate
+        self.pool_size = max(1, pool_size)
+        self.size_bytes = size_bytes
+        self.load_time = load_time
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        """
+        Take a recognizer from the pool, creating one if the pool isn't full yet.
+        Hand it back with ``release()``.
+
+        Raises:
+            queue.Empty: if none became free within timeout seconds.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            from vosk import KaldiRecognizer
+            try:
+                return KaldiRecognizer(self.model, self.sample_rate)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool exhausted, wait for another request to hand one back
+        return self._idle.get(timeout=timeout)
+
+    def release(self, rec):
+        try:
+            rec.Reset()
+        except Exception as e:
+            # A recognizer we can't reset is not safe to reuse
+            logger.warning(f"Discarding Vosk recognizer that failed to reset: {e}")
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(rec)
+
+    @contextmanager
+    def recognizer(self, timeout=None):
+        """Borrow a KaldiRecognizer from the pool for the duration of the block."""
+        rec = self.acquire(timeout)
+        try:
+            yield rec
+        finally:
+            self.release(rec)
+
+
+class VoskModelRegistry:
+    """
+    Loads Vosk models on demand and keeps them in an LRU cache.
+
+    Each request language is mapped to a model directory under ``models_dir``
+    (``<models_dir>/en-us``, then ``<models_dir>/en``), falling back to
+    ``default_model_path``. A model is validated and loaded the first time it is
+    needed and then shared by every request in the worker. When the combined
+    size of the loaded models exceeds ``memory_budget`` bytes, the least
+    recently used models are evicted. A budget of 0 means no limit.
+
+    Loads are serialized by a lock so the same model is never loaded twice and
+    resident size measurements aren't mixed up. A failed load is remembered so
+    the directory isn't re-scanned on every request.
+    """
+
+    def __init__(self, default_model_path, models_dir=None, memory_budget=0, pool_size=4, sample_rate=16000):
+        self.default_model_path = default_model_path
+        self.models_dir = models_dir
+        self.memory_budget = memory_budget
+        self.pool_size = pool_size
+        self.sample_rate = sample_rate
+        self._models = OrderedDict()
+        self._paths = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def model_path_for(self, language=None):
+        """Return the model directory to use for a language code such as 'en-us'."""
+        if not self.models_dir or not language:
+            return self.default_model_path
+
+        language = language.lower().replace('_', '-')
+        path = self._paths.get(language)
+        if path is None:
+            path = self.default_model_path
+            for candidate in (language, language.split('-')[0]):
+                candidate_path = os.path.join(self.models_dir, candidate)
+                if os.path.isdir(candidate_path):
+                    path = candidate_path
+                    break
+            self._paths[language] = path
+        return path
+
+    def _load(self, model_path):
+        if not validate_model_dir(model_path):
+            return None
+
+        from vosk import Model
+
+        rss_before = _resident_bytes()
+        load_start = time.time()
+        model = Model(model_path)
+        load_time = time.time() - load_start
+        size_bytes = max(0, _resident_bytes() - rss_before) or _dir_size_bytes(model_path)
+
+        logger.info(
+            f"Loaded Vosk model from {model_path} in {load_time:.3f}s "
+            f"(+{size_bytes / (1024 * 1024):.1f} MB resident)"
+        )
+        return LoadedModel(model_path, model, self.sample_rate, self.pool_size,
+                           size_bytes=size_bytes, load_time=load_time)
+
+    def _evict(self, keep):
+        # Caller holds self._lock
+        if not self.memory_budget:
+            return
+        total = sum(m.size_bytes for m in self._models.values())
+        for path in list(self._models):
+            if total <= self.memory_budget:
+                break
+            if path == keep:
+                continue
+            # Requests still holding a recognizer keep the model alive until they finish
+            evicted = self._models.pop(path)
+            total -= evicted.size_bytes
+            self.evictions += 1
+            logger.info(f"Evicted Vosk model {path} ({evicted.size_bytes / (1024 * 1024):.1f} MB) to stay within memory budget")
+
+    def get(self, language=None):
+        """Return the LoadedModel for a language, loading it on first use, or None if it can't be loaded."""
+        path = self.model_path_for(language)
+
+        with self._lock:
+            loaded = self._models.get(path)
+            if loaded is not None:
+                self._models.move_to_end(path)
+                self.hits += 1
+                return loaded
+            if path in self._failed:
+                return None
+
+        with self._load_lock:
+            # Another request may have loaded it while we were waiting
+            with self._lock:
+                loaded = self._models.get(path)
+                if loaded is not None:
+                    self._models.move_to_end(path)
+                    self.hits += 1
+                    return loaded
+                self.misses += 1
+
+            try:
+                loaded = self._load(path)
+            except Exception as e:
+                logger.error(f"Failed to initialize Vosk model: {e}")
+                loaded = None
+
+            with self._lock:
+                if loaded is None:
+                    self._failed.add(path)
+                    return None
+                self._models[path] = loaded
+                self._evict(keep=path)
+        return loaded
+
+    def preload(self, language=None):
+        """Load a model eagerly, e.g. at worker start."""
+        return self.get(language) is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded_models': len(self._models),
+                'resident_bytes': sum(m.size_bytes for m in self._models.values()),
+                'memory_budget_bytes': self.memory_budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,376 @@
+import os
+import time
+import queue
+import select
+import signal
+import logging
+import threading
+import multiprocessing
+
+from .vosk_stream import accept, final_text
+
+logger = logging.getLogger('rebble-asr')
+
+# Signals whose handlers the worker process must not inherit from gunicorn/gevent
+_RESET_SIGNALS = ['SIGTERM', 'SIGINT', 'SIGQUIT', 'SIGHUP', 'SIGUSR1', 'SIGUSR2', 'SIGWINCH', 'SIGCHLD']
+
+
+def _drain(rx):
+    # Skip the rest of a job's audio, up to the empty block that ends it
+    while rx.recv_bytes():
+        pass
+
+
+def _worker_main(registry, rx, tx, parent_pid):
+    """
+    Entry point of a Vosk worker process: decode jobs from rx, answer on tx.
+
+    A job is the request language followed by its audio in one or more
+    blocks, ending with an empty block. Blocks are decoded as they arrive, so
+    a dictation streamed in while it is uploaded is ready soon after its last
+    block.
+    """
+    for name in _RESET_SIGNALS:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+
+    while True:
+        try:
+            # Wake up now and then so we notice if the web worker went away
+            if not rx.poll(1.0):
+                if os.getppid() != parent_pid:
+                    return
+                continue
+            language = rx.recv()
+        except (EOFError, OSError):
+            return
+
+        ended = False
+        try:
+            loaded = registry.get(language)
+            if loaded is None:
+                _drain(rx)
+                tx.send(('error', 'Vosk model not available'))
+                continue
+            segments = []
+            with loaded.recognizer() as rec:
+                block = rx.recv_bytes()
+                while block:
+                    accept(rec, block, segments)
+                    block = rx.recv_bytes()
+                ended = True
+                text = final_text(rec, segments)
+            tx.send(('ok', text))
+        except (EOFError, OSError):
+            return
+        except Exception as e:
+            try:
+                if not ended:
+                    _drain(rx)
+                tx.send(('error', str(e)))
+            except (EOFError, OSError):
+                return
+
+
+class _Worker:
+    def __init__(self, process, tx, rx):
+        self.process = process
+        self.tx = tx
+        self.rx = rx
+
+
+class VoskProcessPool:
+    """
+    Runs Vosk recognition in a pool of pre-forked worker processes.
+
+    AcceptWaveform is a long native call that would otherwise stall every
+    greenlet in the web worker. Jobs are handed to idle worker processes over
+    pipes and the caller waits on the pipe, which gevent treats as cooperative
+    I/O, so the web worker keeps serving other requests while decoding runs on
+    other cores.
+
+    The workers are forked from the web worker after the default model has been
+    loaded, so they start warm and share the model pages copy-on-write.
+
+    At most ``max_queue`` requests wait for a free worker; further requests are
+    rejected immediately. A job that takes longer than ``timeout`` seconds
+    (including time spent queued) is abandoned and its worker is restarted.
+    """
+
+    def __init__(self, registry, processes=2, max_queue=16, timeout=30.0):
+        self.registry = registry
+        self.processes = max(1, processes)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._ctx = multiprocessing.get_context('fork')
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self.queued = 0
+        self.max_queued = 0
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.streamed = 0
+
+    def _spawn(self):
+        job_rx, job_tx = self._ctx.Pipe(duplex=False)
+        result_rx, result_tx = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(self.registry, job_rx, result_tx, os.getpid()),
+            name='vosk-worker',
+            daemon=True,
+        )
+        process.start()
+        # The child has its own copies of these ends
+        job_rx.close()
+        result_tx.close()
+        return _Worker(process, job_tx, result_rx)
+
+    def _discard(self, worker):
+        try:
+            worker.process.kill()
+            worker.process.join(1)
+        except Exception:
+            pass
+        worker.tx.close()
+        worker.rx.close()
+
+    def start(self):
+        """Fork the worker processes. Load models into the registry first so they start warm."""
+        if self._started:
+            return
+        start_time = time.time()
+        for _ in range(self.processes):
+            self._idle.put(self._spawn())
+        self._started = True
+        logger.info(f"Started {self.processes} Vosk worker processes in {time.time() - start_time:.3f}s")
+
+    def transcribe(self, audio, language=None, deadline=None):
+        """
+        Recognise audio in a worker process, giving up at ``deadline`` (as
+        time.time()) if that comes before the pool's own timeout.
+
+        Returns:
+            The transcript text, or None if the job was rejected, timed out or failed.
+        """
+        start = time.time()
+        deadline = min(deadline, start + self.timeout) if deadline is not None else start + self.timeout
+
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            worker = None
+
+        if worker is None:
+            # Every worker is busy, wait in line if there is room
+            with self._lock:
+                if self.queued >= self.max_queue:
+                    self.rejected += 1
+                    logger.warning(f"Vosk worker queue full ({self.queued} waiting), rejecting job")
+                    return None
+                self.queued += 1
+                self.max_queued = max(self.max_queued, self.queued)
+
+            try:
+                worker = self._idle.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                pass
+            finally:
+                with self._lock:
+                    self.queued -= 1
+
+        if worker is None:
+            with self._lock:
+                self.timeouts += 1
+            logger.error(f"Timed out after {time.time() - start:.1f}s waiting for a Vosk worker")
+            return None
+
+        with self._lock:
+            self.busy += 1
+
+        def send():
+            # The audio goes over the pipe as raw bytes, without pickling a copy first
+            worker.tx.send(language)
+            worker.tx.send_bytes(audio)
+            worker.tx.send_bytes(b'')
+
+        return self._run(worker, send, start, deadline)
+
+    def _run(self, worker, send, start, deadline):
+        """Send (the rest of) a job to a busy worker and wait for its answer, then put the worker back."""
+        try:
+            send()
+            if not worker.rx.poll(max(0.0, deadline - time.time())):
+                with self._lock:
+                    self.timeouts += 1
+                logger.error(f"Vosk worker did not finish within {deadline - start:.1f}s, restarting it")
+                self._discard(worker)
+                worker = self._spawn()
+                with self._lock:
+                    self.restarts += 1
+                return None
+
+            status, payload = worker.rx.recv()
+            if status != 'ok':
+                with self._lock:
+                    self.failed += 1
+                logger.error(f"Vosk worker error: {payload}")
+                return None
+
+            with self._lock:
+                self.completed += 1
+            return payload
+
+        except (EOFError, OSError) as e:
+            logger.error(f"Vosk worker died: {e}, restarting it")
+            self._discard(worker)
+            worker = self._spawn()
+            with self._lock:
+                self.failed += 1
+                self.restarts += 1
+            return None
+        except BaseException:
+            # The caller was cancelled (e.g. a hedged request lost the race) while the
+            # job was in flight; its answer would be read by the next job, so start over
+            self._discard(worker)
+            worker = self._spawn()
+            with self._lock:
+                self.restarts += 1
+            raise
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self._idle.put(worker)
+
+    def _abandon(self, worker):
+        """Replace a busy worker that is part-way through a job, e.g. when the upload failed."""
+        self._discard(worker)
+        replacement = self._spawn()
+        with self._lock:
+            self.busy -= 1
+            self.restarts += 1
+        self._idle.put(replacement)
+
+    def stream(self, language=None, block_bytes=6400):
+        """
+        Start recognising a dictation in a worker process while it is still
+        being uploaded.
+
+        Returns:
+            A VoskPoolStream, or None if no worker is free right now; the
+            audio is then transcribed once the upload is complete.
+        """
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            return None
+
+        with self._lock:
+            self.busy += 1
+            self.streamed += 1
+        try:
+            worker.tx.send(language)
+        except (EOFError, OSError) as e:
+            logger.error(f"Vosk worker died: {e}, restarting it")
+            with self._lock:
+                self.failed += 1
+            self._abandon(worker)
+            return None
+        return VoskPoolStream(self, worker, block_bytes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.processes,
+                'busy': self.busy,
+                'queue_depth': self.queued,
+                'max_queue_depth': self.max_queued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                'rejected': self.rejected,
+                'restarts': self.restarts,
+                'streamed': self.streamed,
+            }
+
+
+class VoskPoolStream:
+    """
+    A dictation recognised by a worker process while it is being uploaded
+    (see ``VoskProcessPool.stream()``).
+
+    Decoded PCM written to the stream is sent to the worker in blocks of
+    ``block_bytes``, where it is decoded straight away on another core.
+    ``finish()`` then only waits for the last block.
+    """
+
+    def __init__(self, pool, worker, block_bytes=6400):
+        self.pool = pool
+        self.block_bytes = block_bytes
+        self._worker = worker
+        self._pending = bytearray()
+        self.failed = False
+        self.bytes_sent = 0
+
+    def _send(self, block):
+        try:
+            self._worker.tx.send_bytes(block)
+        except (EOFError, OSError) as e:
+            logger.error(f"Vosk worker died: {e}, restarting it")
+            self.failed = True
+            with self.pool._lock:
+                self.pool.failed += 1
+            self.close()
+            return
+        self.bytes_sent += len(block)
+
+    def write(self, pcm):
+        if self._worker is None:
+            return
+        self._pending += pcm
+        # When the worker is behind the pipe fills up; keep the audio here until it
+        # catches up rather than block the event loop on the write
+        if len(self._pending) >= self.block_bytes and select.select([], [self._worker.tx], [], 0)[1]:
+            self._send(bytes(self._pending))
+            self._pending.clear()
+
+    def finish(self, deadline=None):
+        """
+        Send the rest of the audio and wait for the transcript, giving up at
+        ``deadline`` (as time.time()) or after the pool's timeout.
+
+        Returns:
+            The transcript text, or None if recognition failed or timed out.
+        """
+        if self._pending and self._worker is not None:
+            self._send(bytes(self._pending))
+            self._pending.clear()
+        if self._worker is None:
+            return None
+
+        worker, self._worker = self._worker, None
+        start = time.time()
+        limit = start + self.pool.timeout
+        return self.pool._run(worker, lambda: worker.tx.send_bytes(b''), start,
+                              min(deadline, limit) if deadline is not None else limit)
+
+    def close(self):
+        """
+        Drop the dictation, e.g. when the upload failed or the transcript was
+        cached. The worker finishes the job in the background before it takes
+        the next one; a worker that can't be written to is replaced.
+        """
+        if self._worker is None:
+            return
+        worker, self._worker = self._worker, None
+        if self.failed:
+            self.pool._abandon(worker)
+            return
+        start = time.time()
+        threading.Thread(target=self.pool._run, args=(worker, lambda: worker.tx.send_bytes(b''), start,
+                                                      start + self.pool.timeout), daemon=True).start()
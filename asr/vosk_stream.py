@@ -0,0 +1,107 @@
+import json
+import time
+import logging
+
+logger = logging.getLogger('rebble-asr')
+
+
+def accept(rec, pcm, segments):
+    """
+    Feed PCM to a Vosk recognizer. Whenever it detects the end of an
+    utterance, the utterance's text is appended to segments.
+    """
+    if rec.AcceptWaveform(pcm):
+        text = json.loads(rec.Result()).get('text', '')
+        if text:
+            segments.append(text)
+
+
+def final_text(rec, segments):
+    """Decode what the recognizer still holds and return the whole transcript."""
+    text = json.loads(rec.FinalResult()).get('text', '')
+    if text:
+        segments.append(text)
+    return ' '.join(segments)
+
+
+class VoskStream:
+    """
+    Recognises a dictation with an in-process Vosk recognizer while it is
+    still being uploaded.
+
+    Decoded PCM written to the stream is fed to the recognizer in blocks of
+    ``block_bytes``. Each utterance Vosk finishes along the way is kept, so
+    by the time the upload ends only the last bit of audio remains to be
+    decoded and ``finish()`` returns almost at once, however long the
+    dictation was.
+
+    The recognizer is borrowed from the model's pool until the stream is
+    finished or closed.
+    """
+
+    def __init__(self, loaded, rec, block_bytes=6400):
+        self.loaded = loaded
+        self.block_bytes = block_bytes
+        self._rec = rec
+        self._pending = bytearray()
+        self._segments = []
+        self.failed = False
+        self.bytes_fed = 0
+        self.decode_time = 0.0
+
+    def _feed(self, pcm):
+        start = time.perf_counter()
+        accept(self._rec, pcm, self._segments)
+        self.decode_time += time.perf_counter() - start
+        self.bytes_fed += len(pcm)
+
+    def write(self, pcm):
+        if self._rec is None:
+            return
+        self._pending += pcm
+        if len(self._pending) < self.block_bytes:
+            return
+        try:
+            self._feed(bytes(self._pending))
+        except Exception as e:
+            logger.error(f"Vosk streaming recognition error: {e}")
+            self.failed = True
+            self.close()
+        self._pending.clear()
+
+    def partial(self):
+        """The transcript so far, including Vosk's guess at the utterance in progress."""
+        if self._rec is None:
+            return ' '.join(self._segments)
+        text = json.loads(self._rec.PartialResult()).get('partial', '')
+        return ' '.join(self._segments + [text] if text else self._segments)
+
+    def finish(self):
+        """
+        Decode the rest of the audio.
+
+        Returns:
+            The transcript text, or None if recognition failed.
+        """
+        if self._rec is None:
+            return None
+        try:
+            if self._pending:
+                self._feed(bytes(self._pending))
+                self._pending.clear()
+            start = time.perf_counter()
+            transcript = final_text(self._rec, self._segments)
+            self.decode_time += time.perf_counter() - start
+            return transcript
+        except Exception as e:
+            logger.error(f"Vosk streaming recognition error: {e}")
+            self.failed = True
+            return None
+        finally:
+            self.close()
+
+    def close(self):
+        """Give the recognizer back, e.g. when the upload failed."""
+        if self._rec is not None:
+            rec, self._rec = self._rec, None
+            self.loaded.release(rec)
@@ -0,0 +1,546 @@
+import time
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from collections import deque
+
+from wyoming.asr import Transcribe, Transcript
+from wyoming.audio import AudioChunk, AudioStart, AudioStop
+from wyoming.client import AsyncTcpClient
+from wyoming.info import Describe, Info
+
+logger = logging.getLogger('rebble-asr')
+
+# asyncio only allows one running loop per OS thread and every greenlet shares
+# the same one, so all Wyoming conversations run on a single background loop
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def use_loop(loop):
+    """
+    Run Wyoming conversations on an existing event loop instead of a background one.
+
+    Used when serving on asyncio (asr.asgi), so conversations run on the
+    server's own loop. Must be called before anything Wyoming is started.
+    """
+    global _loop
+    with _loop_lock:
+        _loop = loop
+
+
+def get_loop():
+    """Return the worker's Wyoming event loop, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='wyoming-loop', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def _is_open(client):
+    reader, writer = client._reader, client._writer
+    return reader is not None and writer is not None and not reader.at_eof() and not writer.is_closing()
+
+
+async def _close(client):
+    try:
+        await client.disconnect()
+    except Exception:
+        pass
+
+
+class WyomingConnectionPool:
+    """
+    Keeps connections to a Wyoming server open and ready for the next request.
+
+    Wyoming ASR servers close the connection after sending a transcript, so
+    connections are not reused between requests. Instead the pool keeps
+    ``size`` spare connections that have already been connected and answered
+    a ``Describe``, so a request only pays for TCP connect and server start-up
+    when the pool has run dry.
+
+    A maintenance task on the background loop tops the pool up after every
+    checkout, re-describes idle connections every ``health_interval`` seconds
+    and drops the ones that don't answer, and backs off while the server is
+    unreachable. ``healthy`` reflects whether the last attempt to reach the
+    server succeeded.
+    """
+
+    def __init__(self, host, port, size=2, connect_timeout=5.0, health_interval=15.0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.health_interval = health_interval
+        self.healthy = True
+        self.info = None
+        self._idle = deque()
+        self._wakeup = None
+        self._started = False
+        self.warm = 0
+        self.cold = 0
+        self.connect_failures = 0
+        self.health_check_failures = 0
+
+    def start(self):
+        """Start keeping warm connections, if the pool has a size."""
+        if not self._started and self.size > 0:
+            self._started = True
+            asyncio.run_coroutine_threadsafe(self._maintain(), get_loop())
+        return self
+
+    async def _describe(self, client):
+        await client.write_event(Describe().event())
+        while True:
+            event = await asyncio.wait_for(client.read_event(), self.connect_timeout)
+            if event is None:
+                raise ConnectionError("Wyoming server closed the connection")
+            if Info.is_type(event.type):
+                self.info = Info.from_event(event)
+                return
+
+    async def connect(self):
+        """Open and describe a new connection."""
+        client = AsyncTcpClient(self.host, self.port)
+        try:
+            await asyncio.wait_for(client.connect(), self.connect_timeout)
+            await self._describe(client)
+        except BaseException:
+            await _close(client)
+            raise
+        return client
+
+    async def acquire(self):
+        """Return a ready connection, preferring a warm one from the pool."""
+        while self._idle:
+            client = self._idle.popleft()
+            if _is_open(client):
+                self.warm += 1
+                self._wake()
+                return client
+            await _close(client)
+
+        self._wake()
+        try:
+            client = await self.connect()
+        except Exception:
+            self.connect_failures += 1
+            self.healthy = False
+            raise
+        self.cold += 1
+        self.healthy = True
+        return client
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _check_idle(self):
+        for _ in range(len(self._idle)):
+            client = self._idle.popleft()
+            try:
+                await self._describe(client)
+            except Exception as e:
+                self.health_check_failures += 1
+                logger.warning(f"Dropping idle Wyoming connection that failed a health check: {e!r}")
+                await _close(client)
+                continue
+            self._idle.append(client)
+
+    async def _maintain(self):
+        self._wakeup = asyncio.Event()
+        backoff = 1.0
+        while True:
+            try:
+                while len(self._idle) < self.size:
+                    self._idle.append(await self.connect())
+                if not self.healthy:
+                    logger.info(f"Wyoming server {self.host}:{self.port} is reachable again")
+                self.healthy = True
+                backoff = 1.0
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.health_interval)
+                except asyncio.TimeoutError:
+                    await self._check_idle()
+                self._wakeup.clear()
+
+            except Exception as e:
+                if self.healthy:
+                    logger.warning(f"Cannot reach Wyoming server {self.host}:{self.port}: {e!r}")
+                self.healthy = False
+                self.connect_failures += 1
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def stats(self):
+        return {
+            'healthy': self.healthy,
+            'idle': len(self._idle),
+            'warm': self.warm,
+            'cold': self.cold,
+            'connect_failures': self.connect_failures,
+            'health_check_failures': self.health_check_failures,
+        }
+
+
+def parse_hosts(value, default_port):
+    """Parse a comma-separated list of ``host[:port]`` entries into (host, port) tuples."""
+    hosts = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, sep, port = entry.rpartition(':')
+        if sep and port.isdigit():
+            hosts.append((host, int(port)))
+        else:
+            hosts.append((entry, default_port))
+    return hosts
+
+
+class WyomingBackend:
+    """
+    One Wyoming server behind the balancer, with its connection pool and load statistics.
+
+    After ``eject_failures`` consecutive failed conversations the backend is
+    ejected for ``eject_seconds`` and receives no traffic unless every other
+    backend is unavailable too.
+    """
+
+    def __init__(self, pool, max_concurrency=0, eject_failures=3, eject_seconds=30.0, ewma_decay=0.3):
+        self.pool = pool
+        self.max_concurrency = max_concurrency
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.ewma_decay = ewma_decay
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+
+    @property
+    def name(self):
+        return f"{self.pool.host}:{self.pool.port}"
+
+    def available(self, now):
+        """True if the backend is healthy, not ejected and below its concurrency limit."""
+        if self.ejected_until > now or not self.pool.healthy:
+            return False
+        return not self.max_concurrency or self.outstanding < self.max_concurrency
+
+    def record(self, ok, latency):
+        # Caller holds the balancer lock
+        self.outstanding -= 1
+        if ok is None:
+            # Abandoned by the caller (upload failed or a hedge won), says nothing about the backend
+            return
+        if ok:
+            self.consecutive_failures = 0
+            if self.ewma_latency:
+                self.ewma_latency += self.ewma_decay * (latency - self.ewma_latency)
+            else:
+                self.ewma_latency = latency
+            return
+
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.eject_failures and self.consecutive_failures >= self.eject_failures:
+            self.ejected_until = time.time() + self.eject_seconds
+            self.consecutive_failures = 0
+            self.ejections += 1
+            logger.warning(f"Ejecting Wyoming backend {self.name} for {self.eject_seconds:.0f}s after repeated failures")
+
+    def stats(self):
+        return {
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'failures': self.failures,
+            'ejections': self.ejections,
+            'ejected': self.ejected_until > time.time(),
+            'ewma_latency': round(self.ewma_latency, 3),
+            'pool': self.pool.stats(),
+        }
+
+
+class WyomingBalancer:
+    """
+    Spreads Wyoming conversations over several backends.
+
+    With the ``least-outstanding`` policy the backend with the fewest
+    conversations in flight wins, ties going to the lower latency EWMA. With
+    ``ewma`` the backend with the lowest latency EWMA weighted by its
+    outstanding conversations wins, which steers traffic away from slow nodes
+    even when they are idle.
+    """
+
+    POLICIES = ('least-outstanding', 'ewma')
+
+    def __init__(self, backends, policy='least-outstanding'):
+        if policy not in self.POLICIES:
+            logger.warning(f"Unknown Wyoming balancing policy '{policy}', using least-outstanding")
+            policy = 'least-outstanding'
+        self.backends = backends
+        self.policy = policy
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for backend in self.backends:
+            backend.pool.start()
+        return self
+
+    def _score(self, backend):
+        if self.policy == 'ewma':
+            return (backend.ewma_latency * (backend.outstanding + 1), backend.outstanding)
+        return (backend.outstanding, backend.ewma_latency)
+
+    def acquire(self):
+        """
+        Pick a backend for a new conversation and count it as outstanding.
+
+        Returns:
+            A WyomingBackend, or None if every backend is at its concurrency limit.
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [b for b in self.backends if b.available(now)]
+            if not candidates:
+                # Everything is ejected or unhealthy: rather than failing outright,
+                # try whichever backend still has room
+                candidates = [b for b in self.backends
+                              if not b.max_concurrency or b.outstanding < b.max_concurrency]
+            if not candidates:
+                self.rejected += 1
+                return None
+
+            backend = min(candidates, key=self._score)
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend, ok, latency):
+        with self._lock:
+            backend.record(ok, latency)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'rejected': self.rejected,
+                'backends': {b.name: b.stats() for b in self.backends},
+            }
+
+
+class WyomingStream:
+    """
+    Streams PCM to a Wyoming ASR server while the request is still arriving.
+
+    ``start()`` connects and sends ``Transcribe`` and ``AudioStart`` right
+    away, ``write()`` forwards audio in fixed-size ``AudioChunk`` events as it
+    is decoded, and ``finish()`` sends ``AudioStop`` and waits for the
+    transcript, so the server only has the tail of the audio left to process
+    once the upload completes.
+
+    The conversation runs as a task on the shared background loop; the calling
+    greenlet only hands data across and waits cooperatively. Time spent
+    connecting, sending and waiting for the transcript is recorded in
+    ``timings``.
+
+    When a balancer or circuit breaker is given, the outcome and latency of
+    the conversation are reported back to it once the conversation ends.
+    """
+
+    def __init__(self, backend, balancer=None, breaker=None, language=None, model=None, rate=16000, width=2,
+                 channels=1, chunk_bytes=3200):
+        self.backend = backend
+        self.balancer = balancer
+        self.breaker = breaker
+        self.pool = backend.pool
+        self.language = language
+        self.model = model
+        self.rate = rate
+        self.width = width
+        self.channels = channels
+        self.chunk_bytes = chunk_bytes
+        self.bytes_sent = 0
+        self.timings = {'connect': 0.0, 'send': 0.0, 'wait': 0.0}
+        self._pending = bytearray()
+        self._loop = get_loop()
+        self._queue = asyncio.Queue()
+        self._future = None
+
+    def start(self):
+        """Begin the Wyoming conversation in the background."""
+        self._future = asyncio.run_coroutine_threadsafe(self._session(), self._loop)
+        if self.balancer is not None or self.breaker is not None:
+            self._future.add_done_callback(self._report)
+        return self
+
+    def _report(self, future):
+        if future.cancelled():
+            ok, latency = None, 0.0
+        else:
+            ok = future.exception() is None and future.result() is not None
+            latency = self.timings['connect'] + self.timings['wait']
+        if self.balancer is not None:
+            self.balancer.release(self.backend, ok, latency)
+        if self.breaker is not None:
+            self.breaker.record(ok, latency)
+
+    @property
+    def failed(self):
+        """True once the conversation has ended without a transcript."""
+        if self._future is None or not self._future.done():
+            return False
+        return self._future.cancelled() or self._future.exception() is not None or self._future.result() is None
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def write(self, pcm):
+        """Queue PCM for sending; full chunks are forwarded immediately."""
+        if self.failed:
+            return
+        view = memoryview(pcm)
+        if self._pending:
+            # Top up the partial chunk left over from the previous write first
+            need = self.chunk_bytes - len(self._pending)
+            self._pending += view[:need]
+            view = view[need:]
+            if len(self._pending) < self.chunk_bytes:
+                return
+            self._put(bytes(self._pending))
+            self._pending.clear()
+
+        # Whole chunks are cut straight from the caller's buffer
+        whole = len(view) - len(view) % self.chunk_bytes
+        for start in range(0, whole, self.chunk_bytes):
+            self._put(bytes(view[start:start + self.chunk_bytes]))
+        self._pending += view[whole:]
+
+    def _end_audio(self):
+        if self._pending:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        self._put(None)
+
+    def finish(self, timeout=None):
+        """
+        Send the remaining audio and wait for the transcript.
+
+        Returns:
+            The transcript text, or None if the conversation failed or timed out.
+        """
+        self._end_audio()
+
+        try:
+            return self._future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            logger.error(f"Wyoming transcription did not complete within {timeout:.1f}s")
+        except concurrent.futures.CancelledError:
+            logger.error("Wyoming transcription was cancelled")
+        except BaseException:
+            # The waiting greenlet was killed, e.g. because a hedged request won
+            self.close()
+            raise
+        self.close()
+        return None
+
+    async def finish_async(self, timeout=None):
+        """Like ``finish()``, for callers running on the conversation's own loop (see ``use_loop()``)."""
+        self._end_audio()
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self._future), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Wyoming transcription did not complete within {timeout:.1f}s")
+        except asyncio.CancelledError:
+            # Either the conversation or the waiting task was cancelled
+            self.close()
+            if asyncio.current_task().cancelling():
+                raise
+            logger.error("Wyoming transcription was cancelled")
+            return None
+        self.close()
+        return None
+
+    def close(self):
+        """Abandon the conversation, e.g. when the upload failed."""
+        if self._future is not None:
+            self._future.cancel()
+
+    async def _begin(self, client):
+        await client.write_event(Transcribe(name=self.model, language=self.language).event())
+        # Begin audio stream
+        await client.write_event(
+            AudioStart(rate=self.rate, width=self.width, channels=self.channels).event()
+        )
+
+    async def _connect(self):
+        client = await self.pool.acquire()
+        try:
+            await self._begin(client)
+        except (OSError, ConnectionError) as e:
+            # A warm connection may have gone stale since its last health check
+            logger.warning(f"Wyoming connection failed ({e!r}), reconnecting")
+            await _close(client)
+            client = await self.pool.connect()
+            await self._begin(client)
+        return client
+
+    async def _session(self):
+        stage_start = time.time()
+        try:
+            client = await self._connect()
+        except Exception as e:
+            logger.error(f"Wyoming transcription error: {e!r}")
+            return None
+        self.timings['connect'] = time.time() - stage_start
+        logger.debug(f"Connected to Wyoming service in {self.timings['connect']:.3f}s")
+
+        try:
+            # Forward audio until the request has been fully received
+            while True:
+                audio = await self._queue.get()
+                send_start = time.time()
+                if audio is None:
+                    break
+                await client.write_event(
+                    AudioChunk(rate=self.rate, width=self.width, channels=self.channels, audio=audio).event()
+                )
+                self.bytes_sent += len(audio)
+                self.timings['send'] += time.time() - send_start
+
+            # End audio stream
+            await client.write_event(AudioStop().event())
+            wait_start = time.time()
+            self.timings['send'] += wait_start - send_start
+            logger.debug(f"Sent {self.bytes_sent} bytes to Wyoming service, waiting for transcription result")
+
+            # Wait for transcription result
+            while True:
+                event = await client.read_event()
+                if event is None:
+                    logger.error("Wyoming connection lost")
+                    return None
+
+                if Transcript.is_type(event.type):
+                    self.timings['wait'] = time.time() - wait_start
+                    transcript = Transcript.from_event(event)
+                    logger.debug(f"Received transcript from Wyoming service: '{transcript.text}'")
+                    return transcript.text
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Wyoming transcription error: {e!r}")
+            return None
+        finally:
+            await _close(client)
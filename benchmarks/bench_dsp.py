@@ -0,0 +1,104 @@
+"""
+Benchmark for the audio clean-up stage.
+
+Compares the previous per-frame loop (``audioop.mul`` by a fixed gain on
+every 20ms frame, plus ``audioop.rms`` per frame for silence detection)
+against the NumPy AudioProcessor, which works on blocks of DSP_BLOCK_MS,
+with and without the optional high-pass filter and resampling.
+
+Also reports how many samples each variant clips, on a speech-like signal
+that gets loud halfway through.
+
+audioop was removed in Python 3.13; there only the NumPy variants run.
+
+Usage:
+    python benchmarks/bench_dsp.py [--seconds 5 30] [--block-ms 100] [--repeat 5]
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asr.dsp import AudioProcessor, rms  # noqa: E402
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 320
+
+
+def synthesize(seconds):
+    """Decoded-looking 20ms frames: quiet speech that gets loud halfway through."""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    voiced = sum(np.sin(2 * math.pi * 140 * h * t) / h for h in range(1, 6))
+    envelope = np.maximum(0.0, np.sin(2 * math.pi * 3 * t))
+    level = np.where(t < seconds / 2, 1500, 9000)
+    noise = np.random.default_rng(0).normal(0, 60, t.size)
+    pcm = np.clip(level * envelope * voiced + noise, -32768, 32767).astype('<i2').tobytes()
+    frame_bytes = FRAME_SAMPLES * 2
+    return [pcm[i:i + frame_bytes] for i in range(0, len(pcm), frame_bytes)]
+
+
+def legacy(frames):
+    out = []
+    for frame in frames:
+        boosted = audioop.mul(frame, 2, 7)
+        audioop.rms(boosted, 2)
+        out.append(boosted)
+    return b''.join(out)
+
+
+def numpy_variant(**kwargs):
+    def run(frames):
+        out = []
+        for block in AudioProcessor(**kwargs).process(frames):
+            rms(block)
+            out.append(block)
+        return b''.join(out)
+    return run
+
+
+def clipped(pcm):
+    samples = np.frombuffer(pcm, dtype='<i2')
+    return int(np.count_nonzero((samples == 32767) | (samples == -32768)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, nargs='+', default=[5, 30])
+    parser.add_argument('--block-ms', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    variants = []
+    if audioop is not None:
+        variants.append(('audioop per frame', legacy))
+    variants += [
+        ('numpy', numpy_variant(block_ms=args.block_ms)),
+        ('numpy + high-pass', numpy_variant(block_ms=args.block_ms, highpass_hz=80)),
+        ('numpy + 8kHz', numpy_variant(block_ms=args.block_ms, output_rate=8000)),
+    ]
+
+    print(f"{'audio':>6} {'variant':>18} {'time':>9} {'per s':>8} {'clipped':>8}")
+    for seconds in args.seconds:
+        frames = synthesize(seconds)
+        for name, run in variants:
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                pcm = run(frames)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{seconds:>5.0f}s {name:>18} {best * 1000:>7.2f}ms {best / seconds * 1e6:>6.0f}us {clipped(pcm):>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Benchmark for the upload encoders used with the cloud providers.
+
+Encodes WAV recordings (e.g. the ones saved with SAVE_RECORDINGS) in every
+upload format and reports the bytes sent, the encoding time and the time the
+upload would take on a link of the given speed. With --url, each encoding is
+also posted to a Groq/OpenAI-compatible transcription endpoint and the
+end-to-end latency is measured.
+
+Without recordings, a synthetic speech-like signal is used instead, which
+compresses differently from real speech; prefer real samples.
+
+Usage:
+    python benchmarks/bench_encoders.py [recordings/*.wav] [--formats wav flac opus]
+        [--uplink-kbps 2000] [--url URL --api-key KEY]
+"""
+import argparse
+import io
+import math
+import os
+import random
+import struct
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asr.encoders import ENCODERS, HAS_SOUNDFILE  # noqa: E402
+
+import requests  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+
+def synthesize(seconds):
+    """A voiced, syllable-modulated tone with some noise, as 16kHz mono WAV."""
+    rnd = random.Random(0)
+    samples = []
+    for i in range(int(seconds * SAMPLE_RATE)):
+        t = i / SAMPLE_RATE
+        pitch = 120 + 20 * math.sin(2 * math.pi * 0.5 * t)
+        envelope = max(0.0, math.sin(2 * math.pi * 3 * t))
+        voiced = sum(math.sin(2 * math.pi * pitch * h * t) / h for h in range(1, 8))
+        samples.append(int(max(-32768, min(32767, 6000 * envelope * voiced + rnd.gauss(0, 200)))))
+    return to_wav(struct.pack(f'<{len(samples)}h', *samples))
+
+
+def to_wav(pcm):
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(pcm)
+    return buf.getvalue()
+
+
+def load_samples(paths, seconds):
+    if not paths:
+        return [(f'synthetic {seconds:.0f}s', synthesize(seconds))]
+    samples = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            samples.append((os.path.basename(path), f.read()))
+    return samples
+
+
+def post(url, api_key, upload):
+    headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+    data = {'model': 'whisper-large-v3', 'response_format': 'json'}
+    start = time.perf_counter()
+    response = requests.post(url, files={'file': upload}, data=data, headers=headers, timeout=60)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', nargs='*', help='16kHz mono WAV files')
+    parser.add_argument('--formats', nargs='+', default=list(ENCODERS))
+    parser.add_argument('--seconds', type=float, default=5, help='length of the synthetic sample')
+    parser.add_argument('--uplink-kbps', type=float, default=2000, help='link speed used to estimate upload time')
+    parser.add_argument('--url', help='transcription endpoint to post every encoding to')
+    parser.add_argument('--api-key', default=os.environ.get('ASR_API_KEY'))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    formats = [name for name in args.formats if name == 'wav' or HAS_SOUNDFILE]
+    if len(formats) < len(args.formats):
+        print("soundfile is not installed, only benchmarking WAV\n")
+
+    header = f"{'sample':>20} {'format':>6} {'bytes':>9} {'ratio':>6} {'encode':>9} {'upload':>9}"
+    print(header + (f" {'end-to-end':>11}" if args.url else ''))
+    for name, wav in load_samples(args.recordings, args.seconds):
+        for fmt in formats:
+            encoder = ENCODERS[fmt]
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                upload = encoder.encode(io.BytesIO(wav))
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            size = upload[1].getbuffer().nbytes
+            upload_time = size * 8 / (args.uplink_kbps * 1000)
+            line = (f"{name[:20]:>20} {fmt:>6} {size:>9} {len(wav) / size:>5.1f}x "
+                    f"{best * 1000:>7.2f}ms {upload_time * 1000:>7.1f}ms")
+            if args.url:
+                upload[1].seek(0)
+                line += f" {post(args.url, args.api_key, upload) * 1000:>9.1f}ms"
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+"""
+Load test for the dictation endpoint (/NmspServlet/).
+
+Builds Nuance-style multipart uploads of Speex frames and posts them at each
+concurrency level, then reports requests/sec, p50/p95/p99 latency, and the
+time per request spent in each stage of the audio pipeline and in each
+provider, taken from /metrics.
+
+By default the app runs in this process (on gevent's WSGI server, as under
+the gunicorn gevent worker) with the cloud providers and Wyoming replaced by
+the stand-ins from standins.py, answering after --latency seconds. With
+--url an already running server is tested instead.
+
+Uploads are synthetic speech-like audio, or WAV recordings (16kHz mono,
+e.g. the ones saved with SAVE_RECORDINGS) given on the command line. They are
+Speex encoded if the speex package has an encoder; otherwise random frames of
+a typical size are sent, which decode to noise. With --realtime each upload
+is sent at the pace a watch records it, in 20ms frames, and the time from the
+end of the upload to the response is reported too.
+
+The transcript cache is disabled for the in-process app so every request is
+transcribed.
+
+Usage:
+    python benchmarks/bench_load.py [recordings/*.wav] [--provider groq] [--concurrency 1 8 32]
+        [--requests 200] [--seconds 4] [--realtime] [--latency 0.3 --jitter 0.1] [--url URL]
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse  # noqa: E402
+import math  # noqa: E402
+import os  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+import wave  # noqa: E402
+
+import gevent  # noqa: E402
+import gevent.pool  # noqa: E402
+import numpy as np  # noqa: E402
+import requests  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from prometheus_client.parser import text_string_to_metric_families  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+try:
+    from speex import SpeexEncoder
+except ImportError:
+    SpeexEncoder = None
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 320
+FRAME_MS = 20
+# Typical size of a wideband Speex frame from a watch, used when there is no encoder
+FRAME_SIZE = 70
+BOUNDARY = b'Nuance_NMSP_load_test_boundary'
+
+
+def synthesize(seconds, seed):
+    """Speech-like 16kHz PCM: a voiced tone with syllable-rate bursts and some noise."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    pitch = 110 + 40 * rng.random()
+    voiced = sum(np.sin(2 * math.pi * pitch * h * t) / h for h in range(1, 6))
+    envelope = np.maximum(0.0, np.sin(2 * math.pi * (2.5 + rng.random()) * t))
+    pcm = 3000 * envelope * voiced + rng.normal(0, 100, t.size)
+    return np.clip(pcm, -32768, 32767).astype('<i2').tobytes()
+
+
+def read_recording(path):
+    with wave.open(path, 'rb') as wav_file:
+        if (wav_file.getframerate(), wav_file.getnchannels(), wav_file.getsampwidth()) != (SAMPLE_RATE, 1, 2):
+            sys.exit(f"{path}: only 16kHz mono 16-bit WAV can be replayed")
+        return wav_file.readframes(wav_file.getnframes())
+
+
+def speex_frames(pcm, seed):
+    frame_bytes = FRAME_SAMPLES * 2
+    count = len(pcm) // frame_bytes
+    if SpeexEncoder is None:
+        rng = np.random.default_rng(seed)
+        return [rng.bytes(FRAME_SIZE) for _ in range(count)]
+    encoder = SpeexEncoder(1)
+    return [encoder.encode(pcm[i * frame_bytes:(i + 1) * frame_bytes]) for i in range(count)]
+
+
+def build_upload(frames):
+    """The request parts and then one part per Speex frame, as a list of chunks to send."""
+    delimiter = b'--' + BOUNDARY
+    head = bytearray()
+    for name in (b'RequestData', b'DictParameter', b'DictParameter'):
+        head += delimiter + b'\r\nContent-Disposition: form-data; name="' + name + b'"\r\n'
+        head += b'Content-Type: application/JSON; charset=utf-8\r\n\r\n{}\r\n'
+    chunks = [bytes(head)]
+    for frame in frames:
+        chunks.append(delimiter + b'\r\nContent-Disposition: form-data; name="ConcludingAudioParameter"\r\n'
+                      b'Content-Type: audio/x-speex;rate=16000\r\n\r\n' + frame + b'\r\n')
+    chunks.append(delimiter + b'--\r\n')
+    return chunks
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            gevent.sleep(0.1)
+    sys.exit(f"Stand-in did not start listening on port {port}")
+
+
+def start_app(args):
+    """Start the stand-ins and serve the app in this process; returns its URL."""
+    http_port, wyoming_port = free_port(), free_port()
+    standins = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'standins.py'),
+        '--http-port', str(http_port), '--wyoming-port', str(wyoming_port),
+        '--latency', str(args.latency), '--jitter', str(args.jitter),
+    ], stdout=subprocess.DEVNULL)
+    wait_for_port(http_port)
+    if args.provider == 'wyoming-whisper':
+        wait_for_port(wyoming_port)
+
+    standin_url = f'http://127.0.0.1:{http_port}/v1/audio/transcriptions'
+    os.environ['ASR_API_PROVIDER'] = args.provider
+    os.environ.setdefault('ASR_API_KEY', 'load-test')
+    os.environ['GROQ_API_URL'] = standin_url
+    os.environ['ELEVENLABS_API_URL'] = standin_url
+    os.environ['WYOMING_HOST'] = '127.0.0.1'
+    os.environ['WYOMING_PORT'] = str(wyoming_port)
+    os.environ.setdefault('TRANSCRIPT_CACHE_SIZE', '0')
+
+    import logging
+    from gevent.pywsgi import WSGIServer
+    import asr
+    logging.getLogger('rebble-asr').setLevel(logging.WARNING)
+
+    server = WSGIServer(('127.0.0.1', 0), asr.app, log=None)
+    server.start()
+    return f'http://127.0.0.1:{server.server_port}', standins
+
+
+def scrape(session, url):
+    """Sum and count of every histogram series on /metrics, by (name, labels)."""
+    totals = {}
+    response = session.get(f'{url}/metrics', timeout=10)
+    if response.status_code != 200:
+        return totals
+    for family in text_string_to_metric_families(response.text):
+        for sample in family.samples:
+            if sample.name.endswith(('_sum', '_count')):
+                name, kind = sample.name.rsplit('_', 1)
+                key = (name, tuple(sorted(sample.labels.items())))
+                totals.setdefault(key, {})[kind] = sample.value
+    return totals
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def send(session, url, upload, realtime):
+    """Post one upload; returns (status, latency, seconds from the end of the upload to the response)."""
+    finished = []
+
+    def paced():
+        for chunk in upload:
+            yield chunk
+            gevent.sleep(FRAME_MS / 1000)
+        finished.append(time.perf_counter())
+
+    start = time.perf_counter()
+    try:
+        response = session.post(f'{url}/NmspServlet/', data=paced() if realtime else b''.join(upload),
+                                headers={'Content-Type': f'multipart/form-data; boundary={BOUNDARY.decode()}'},
+                                timeout=120)
+        status = response.status_code
+    except requests.RequestException:
+        status = None
+    end = time.perf_counter()
+    return status, end - start, end - (finished[0] if finished else start)
+
+
+def run_level(session, url, uploads, concurrency, count, realtime):
+    pool = gevent.pool.Pool(concurrency)
+    results = []
+    start = time.perf_counter()
+    for i in range(count):
+        pool.spawn(lambda upload=uploads[i % len(uploads)]: results.append(send(session, url, upload, realtime)))
+    pool.join()
+    return results, time.perf_counter() - start
+
+
+def report_breakdown(before, after, count):
+    rows = []
+    for key, values in sorted(after.items()):
+        name, labels = key
+        if name not in ('asr_stage_duration_seconds', 'asr_provider_duration_seconds'):
+            continue
+        previous = before.get(key, {})
+        calls = values.get('count', 0) - previous.get('count', 0)
+        seconds = values.get('sum', 0) - previous.get('sum', 0)
+        if calls <= 0:
+            continue
+        labels = dict(labels)
+        if name == 'asr_stage_duration_seconds':
+            kind, label = 'stage', labels['stage']
+        else:
+            kind, label = 'provider', f"{labels['provider']} ({labels['outcome']})"
+        rows.append(f"    {kind:>8} {label:<24} {calls:>6.0f} calls {seconds / calls * 1000:>9.2f}ms mean "
+                    f"{seconds / count * 1000:>9.2f}ms per request")
+    if rows:
+        print('\n'.join(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', nargs='*', help='16kHz mono WAV files to replay')
+    parser.add_argument('--provider', default='groq', choices=['groq', 'elevenlabs', 'wyoming-whisper', 'vosk'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=200, help='requests per concurrency level')
+    parser.add_argument('--seconds', type=float, default=4, help='length of the synthetic uploads')
+    parser.add_argument('--variants', type=int, default=50, help='number of different synthetic uploads')
+    parser.add_argument('--realtime', action='store_true', help='send each upload at the pace it was recorded')
+    parser.add_argument('--latency', type=float, default=0.3, help='stand-in response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--url', help='test a running server instead of the app in this process')
+    args = parser.parse_args()
+
+    if args.recordings:
+        uploads = [build_upload(speex_frames(read_recording(path), seed)) for seed, path in enumerate(args.recordings)]
+    else:
+        uploads = [build_upload(speex_frames(synthesize(args.seconds, seed), seed)) for seed in range(args.variants)]
+    if SpeexEncoder is None:
+        print("speex has no encoder here, sending random frames\n")
+
+    standins = None
+    url = args.url.rstrip('/') if args.url else None
+    if url is None:
+        url, standins = start_app(args)
+
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=max(args.concurrency)))
+    try:
+        # Warm up connections, decoders and models before measuring
+        send(session, url, uploads[0], False)
+
+        for concurrency in args.concurrency:
+            before = scrape(session, url)
+            results, elapsed = run_level(session, url, uploads, concurrency, args.requests, args.realtime)
+            after = scrape(session, url)
+
+            latencies = [latency for status, latency, _ in results if status == 200]
+            errors = len(results) - len(latencies)
+            line = f"concurrency {concurrency:>4}: {len(results) / elapsed:>7.1f} req/s, {errors} errors"
+            if latencies:
+                line += (f", p50 {percentile(latencies, 50) * 1000:.0f}ms p95 {percentile(latencies, 95) * 1000:.0f}ms "
+                         f"p99 {percentile(latencies, 99) * 1000:.0f}ms max {max(latencies) * 1000:.0f}ms")
+            print(line)
+            if args.realtime and latencies:
+                tails = [tail for status, _, tail in results if status == 200]
+                print(f"    after upload: p50 {percentile(tails, 50) * 1000:.0f}ms p95 {percentile(tails, 95) * 1000:.0f}ms "
+                      f"p99 {percentile(tails, 99) * 1000:.0f}ms")
+            report_breakdown(before, after, len(results))
+    finally:
+        if standins is not None:
+            standins.terminate()
+
+
+if __name__ == '__main__':
+    main()
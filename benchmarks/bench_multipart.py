@@ -0,0 +1,94 @@
+"""
+Micro-benchmark for the NMSP multipart parser.
+
+Builds a synthetic Nuance-style upload (three request parts followed by Speex
+frames) and measures parsing throughput for the streaming parser against the
+previous implementation, which re-scanned an ever-growing bytes buffer.
+
+Usage:
+    python benchmarks/bench_multipart.py [--seconds 10 30 60] [--read-size 4096]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asr.multipart import iter_parts  # noqa: E402
+
+BOUNDARY = b'Nuance_NMSP_benchmark_boundary'
+# Wideband Speex frames are 20ms, so 50 per second of audio
+FRAMES_PER_SECOND = 50
+FRAME_SIZE = 70
+
+
+def build_body(seconds):
+    delimiter = b'--' + BOUNDARY
+    out = bytearray()
+    for name in (b'RequestData', b'DictParameter', b'DictParameter'):
+        out += delimiter + b'\r\nContent-Disposition: form-data; name="' + name + b'"\r\n'
+        out += b'Content-Type: application/JSON; charset=utf-8\r\n\r\n{}\r\n'
+    for i in range(int(seconds * FRAMES_PER_SECOND)):
+        out += delimiter + b'\r\nContent-Disposition: form-data; name="ConcludingAudioParameter"\r\n'
+        out += b'Content-Type: audio/x-speex;rate=16000\r\n\r\n'
+        out += bytes([i % 256]) * FRAME_SIZE + b'\r\n'
+    out += delimiter + b'--\r\n'
+    return bytes(out)
+
+
+def legacy_parse_chunks(stream, read_size):
+    boundary = b'--' + BOUNDARY
+    this_frame = b''
+    while True:
+        content = stream.read(read_size)
+        this_frame += content
+        end = this_frame.find(boundary)
+        if end > -1:
+            frame = this_frame[:end]
+            this_frame = this_frame[end + len(boundary):]
+            if frame != b'':
+                try:
+                    header, content = frame.split(b'\r\n\r\n', 1)
+                except ValueError:
+                    continue
+                yield content[:-2]
+        if content == b'':
+            break
+
+
+def streaming_parse_chunks(stream, read_size):
+    for part in iter_parts(stream, BOUNDARY, read_size):
+        yield part.body
+
+
+def measure(parse, body, read_size, repeat):
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = sum(1 for _ in parse(io.BytesIO(body), read_size))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, nargs='+', default=[10, 30, 60, 120])
+    parser.add_argument('--read-size', type=int, default=4096)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'audio':>8} {'body':>10} {'parser':>10} {'frames':>7} {'time':>9} {'MB/s':>8}")
+    for seconds in args.seconds:
+        body = build_body(seconds)
+        for name, parse in (('legacy', legacy_parse_chunks), ('streaming', streaming_parse_chunks)):
+            elapsed, frames = measure(parse, body, args.read_size, args.repeat)
+            throughput = len(body) / elapsed / (1024 * 1024)
+            print(f"{seconds:>7.0f}s {len(body):>10} {name:>10} {frames:>7} {elapsed * 1000:>7.2f}ms {throughput:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
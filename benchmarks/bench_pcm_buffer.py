@@ -0,0 +1,136 @@
+"""
+Per-request memory benchmark for the decoded audio pipeline.
+
+Replays decoded 20ms frames through the previous pipeline (bytearray, then a
+WAV file built in a BytesIO and read back out for each provider) and through
+PcmBuffer (one preallocated buffer, read through views), and reports the
+peak memory allocated while handing the audio to each kind of provider:
+
+    upload   a cloud provider that needs a WAV file (Groq, ElevenLabs)
+    stream   Wyoming, which takes raw PCM in 100ms chunks
+    vosk     in-process Vosk, which takes raw PCM bytes
+
+Peak memory is also shown as a multiple of the PCM size, i.e. roughly how
+many copies of the audio were alive at once.
+
+Usage:
+    python benchmarks/bench_pcm_buffer.py [--seconds 5 15 30] [--repeat 5]
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asr.audio import PcmBuffer, estimate_pcm_size  # noqa: E402
+
+FRAME_BYTES = 640
+CHUNK_BYTES = 3200
+# Size of one Speex frame part in the upload, used to size the buffer like the server does
+UPLOAD_BYTES_PER_FRAME = 225
+
+
+def legacy_collect(frames):
+    pcm_data = bytearray()
+    for frame in frames:
+        pcm_data.extend(frame)
+    wav_buffer = io.BytesIO()
+    with wave.open(wav_buffer, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(16000)
+        wav_file.writeframes(pcm_data)
+    wav_buffer.seek(0)
+    return wav_buffer
+
+
+def legacy_upload(wav_buffer):
+    wav_buffer.seek(0)
+    return len(wav_buffer.read())
+
+
+def legacy_stream(wav_buffer):
+    wav_buffer.seek(0)
+    with wave.open(wav_buffer, 'rb') as wav_file:
+        audio_data = wav_file.readframes(wav_file.getnframes())
+    pending = bytearray(audio_data)
+    sent = 0
+    while len(pending) >= CHUNK_BYTES:
+        sent += len(bytes(pending[:CHUNK_BYTES]))
+        del pending[:CHUNK_BYTES]
+    return sent
+
+
+def legacy_vosk(wav_buffer):
+    wav_buffer.seek(0)
+    return len(wav_buffer.read())
+
+
+def buffer_collect(frames):
+    audio = PcmBuffer(estimate_pcm_size(len(frames) * UPLOAD_BYTES_PER_FRAME))
+    for frame in frames:
+        audio.write(frame)
+    return audio
+
+
+def buffer_upload(audio):
+    return len(audio.wav().read())
+
+
+def buffer_stream(audio):
+    view = audio.pcm
+    sent = 0
+    for start in range(0, len(view) - len(view) % CHUNK_BYTES, CHUNK_BYTES):
+        sent += len(bytes(view[start:start + CHUNK_BYTES]))
+    return sent
+
+
+def buffer_vosk(audio):
+    return len(bytes(audio.pcm))
+
+
+PIPELINES = {
+    'legacy': (legacy_collect, {'upload': legacy_upload, 'stream': legacy_stream, 'vosk': legacy_vosk}),
+    'buffer': (buffer_collect, {'upload': buffer_upload, 'stream': buffer_stream, 'vosk': buffer_vosk}),
+}
+
+
+def measure(collect, consume, frames, repeat):
+    # Timed separately, tracing allocations slows the pipelines down unevenly
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        consume(collect(frames))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    consume(collect(frames))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, nargs='+', default=[5, 15, 30])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'audio':>6} {'consumer':>9} {'pipeline':>9} {'peak KiB':>9} {'copies':>7} {'time':>9}")
+    for seconds in args.seconds:
+        frames = [os.urandom(FRAME_BYTES) for _ in range(int(seconds * 50))]
+        pcm_size = len(frames) * FRAME_BYTES
+        for consumer in ('upload', 'stream', 'vosk'):
+            for name, (collect, consumers) in PIPELINES.items():
+                peak, elapsed = measure(collect, consumers[consumer], frames, args.repeat)
+                print(f"{seconds:>5.0f}s {consumer:>9} {name:>9} {peak / 1024:>9.0f} "
+                      f"{peak / pcm_size:>6.1f}x {elapsed * 1000:>7.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
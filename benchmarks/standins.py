@@ -0,0 +1,158 @@
+"""
+Local stand-ins for the remote transcription providers.
+
+    http       Answers Groq/ElevenLabs transcription requests (any POST) with
+               a JSON transcript, as both providers do
+    wyoming    Speaks the Wyoming protocol: reads a Transcribe, AudioStart,
+               AudioChunks and AudioStop, then sends back a Transcript
+
+Each answers after a tunable latency (mean plus uniform jitter), counted from
+the end of the upload, so the server can be load-tested without real APIs.
+Used by bench_load.py, or run on their own and point GROQ_API_URL /
+ELEVENLABS_API_URL / WYOMING_HOST at them.
+
+Usage:
+    python benchmarks/standins.py [--http-port 18080] [--wyoming-port 10300]
+        [--latency 0.3] [--jitter 0.1] [--failure-rate 0]
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Latency:
+    """Response delay of a stand-in: ``mean`` seconds, give or take ``jitter``, failing ``failure_rate`` of the time."""
+
+    def __init__(self, mean=0.3, jitter=0.0, failure_rate=0.0):
+        self.mean = mean
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def delay(self):
+        return max(0.0, self.mean + random.uniform(-self.jitter, self.jitter))
+
+    def fails(self):
+        return random.random() < self.failure_rate
+
+
+class StandinHTTPServer:
+    """Groq/ElevenLabs stand-in, answering every POST with ``{"text": ...}``."""
+
+    def __init__(self, port, latency):
+        self.latency = latency
+        self.requests = 0
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                standin.requests += 1
+                time.sleep(standin.latency.delay())
+                if standin.latency.fails():
+                    self.send_error(503)
+                    return
+                payload = json.dumps({'text': f'stand-in transcript of {len(body)} bytes'}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{port}/v1/audio/transcriptions'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='standin-http', daemon=True).start()
+        return self
+
+
+class StandinWyomingServer:
+    """Wyoming ASR stand-in, answering each AudioStop with a Transcript."""
+
+    def __init__(self, port, latency):
+        self.port = port
+        self.latency = latency
+        self.requests = 0
+
+    def _handler(self):
+        from wyoming.asr import Transcript
+        from wyoming.audio import AudioChunk, AudioStop
+        from wyoming.info import AsrModel, AsrProgram, Attribution, Describe, Info
+        from wyoming.server import AsyncEventHandler
+
+        standin = self
+        attribution = Attribution(name='stand-in', url='')
+
+        class Handler(AsyncEventHandler):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.received = 0
+
+            async def handle_event(self, event):
+                if Describe.is_type(event.type):
+                    model = AsrModel(name='stand-in', description='', attribution=attribution, installed=True,
+                                     languages=['en'], version='1')
+                    program = AsrProgram(name='stand-in', description='', attribution=attribution, installed=True,
+                                         version='1', models=[model])
+                    await self.write_event(Info(asr=[program]).event())
+                elif AudioChunk.is_type(event.type):
+                    self.received += len(AudioChunk.from_event(event).audio)
+                elif AudioStop.is_type(event.type):
+                    standin.requests += 1
+                    await asyncio.sleep(standin.latency.delay())
+                    if standin.latency.fails():
+                        return False
+                    await self.write_event(Transcript(text=f'stand-in transcript of {self.received} bytes').event())
+                    self.received = 0
+                return True
+
+        return Handler
+
+    def _run(self, handler):
+        from wyoming.server import AsyncServer
+        server = AsyncServer.from_uri(f'tcp://127.0.0.1:{self.port}')
+        asyncio.new_event_loop().run_until_complete(server.run(handler))
+
+    def start(self):
+        # Built here so a missing wyoming package is reported to the caller
+        handler = self._handler()
+        threading.Thread(target=self._run, args=(handler,), name='standin-wyoming', daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--http-port', type=int, default=18080)
+    parser.add_argument('--wyoming-port', type=int, default=10300)
+    parser.add_argument('--latency', type=float, default=0.3, help='mean response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    latency = Latency(args.latency, args.jitter, args.failure_rate)
+    http = StandinHTTPServer(args.http_port, latency).start()
+    print(f"HTTP stand-in: GROQ_API_URL={http.url} ELEVENLABS_API_URL={http.url}")
+    try:
+        StandinWyomingServer(args.wyoming_port, latency).start()
+        print(f"Wyoming stand-in: WYOMING_HOST=127.0.0.1 WYOMING_PORT={args.wyoming_port}")
+    except ImportError:
+        print("wyoming is not installed, no Wyoming stand-in")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+# Loaded automatically by gunicorn from the working directory.
+import os
+import glob
+
+
+def on_starting(server):
+    # Metrics from a previous run would otherwise be added to the new ones
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    # Stop counting a dead worker's in-flight requests
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,48 @@
+from asr.audio import DecoderPool
+
+
+class ResettableDecoder:
+    def __init__(self):
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+
+class PlainDecoder:
+    pass
+
+
+def test_resettable_decoders_are_reused():
+    pool = DecoderPool(ResettableDecoder, max_idle=2)
+    with pool.decoder() as first:
+        pass
+    with pool.decoder() as second:
+        pass
+    assert second is first
+    assert first.resets == 2
+    assert pool.reusable()
+    assert pool.stats()['created'] == 1
+    assert pool.stats()['discarded'] == 0
+
+
+def test_decoders_without_reset_are_discarded():
+    pool = DecoderPool(PlainDecoder, max_idle=2)
+    with pool.decoder() as first:
+        pass
+    with pool.decoder() as second:
+        pass
+    assert second is not first
+    assert not pool.reusable()
+    stats = pool.stats()
+    assert stats['idle'] == 0
+    assert stats['created'] == 3
+    assert stats['discarded'] == 3
+
+
+def test_concurrent_requests_get_their_own_decoders():
+    pool = DecoderPool(ResettableDecoder)
+    with pool.decoder() as first, pool.decoder() as second:
+        assert first is not second
+        assert pool.stats()['in_use'] == 2
+    assert pool.stats()['in_use'] == 0